@@ -0,0 +1 @@
+"""Benchmarks for the Protocoldude, run them from the repository root, e.g. python3 -m benchmarks.parser"""
@@ -0,0 +1,190 @@
+"""in-process stand-ins for the LDAP directory, the SMTP relay and the pad server"""
+
+import hashlib
+import http.server
+import re
+import socketserver
+import threading
+import time
+
+
+class FakeDirectory(object):
+    """
+    Answers the uid and group (cn) OR filters of LdapResolver from dicts, in
+    place of a connection returned by ldap.initialize().
+    """
+
+    def __init__(self, mails: dict, latency=0.0, groups=None):
+        self.mails = mails
+        self.latency = latency
+        # group cn -> member uids
+        self.groups = groups or {}
+        self.searches = 0
+
+    def search_s(self, base, scope, query, attrlist=None):
+        self.searches += 1
+        time.sleep(self.latency)
+        cns = re.findall(r"\(cn=([^)]*)\)", query)
+        if cns:
+            return [
+                ("cn={},{}".format(cn, base), {"cn": [cn.encode("utf-8")],
+                                               "memberUid": [uid.encode("utf-8") for uid in self.groups[cn]]})
+                for cn in cns if cn in self.groups
+            ]
+        uids = re.findall(r"\(uid=([^)]*)\)", query)
+        return [
+            ("uid={},{}".format(uid, base), {"uid": [uid.encode("utf-8")], "mail": [self.mails[uid].encode("utf-8")]})
+            for uid in uids if uid in self.mails
+        ]
+
+    def unbind_s(self):
+        pass
+
+
+class SmtpSink(object):
+    """
+    Minimal SMTP server in a background thread that accepts and counts every
+    mail, optionally with a delay per DATA command. With defer_every set,
+    every n-th mail is deferred with a 451 answer like a throttling relay.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0, defer_every=0):
+        sink = self
+
+        class Handler(_SmtpHandler):
+            pass
+        Handler.sink = sink
+
+        self.latency = latency
+        self.defer_every = defer_every
+        self.messages = 0
+        self.bytes = 0
+        self.transactions = 0
+        self.deferred = 0
+        self.lock = threading.Lock()
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def address(self) -> str:
+        return "{}:{}".format(*self.server.server_address)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def received(self, size) -> bool:
+        """counts a mail, returns False if it is deferred instead"""
+        with self.lock:
+            self.transactions += 1
+            if self.defer_every and self.transactions % self.defer_every == 0:
+                self.deferred += 1
+                return False
+            self.messages += 1
+            self.bytes += size
+            return True
+
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    sink = None
+
+    def reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        self.reply("220 sink ESMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command = line[:4].upper()
+            if command == b"EHLO":
+                self.reply("250-sink")
+                self.reply("250 PIPELINING")
+            elif command == b"HELO":
+                self.reply("250 sink")
+            elif command in (b"MAIL", b"RCPT", b"RSET", b"NOOP"):
+                self.reply("250 OK")
+            elif command == b"DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                for data in iter(self.rfile.readline, b""):
+                    if data == b".\r\n":
+                        break
+                    size += len(data)
+                time.sleep(self.sink.latency)
+                if self.sink.received(size):
+                    self.reply("250 OK")
+                else:
+                    self.reply("451 4.7.1 Too many mails, try again later")
+            elif command == b"QUIT":
+                self.reply("221 Bye")
+                break
+            else:
+                self.reply("502 Command not implemented")
+
+
+class PadServer(object):
+    """
+    HTTP server in a background thread that serves a protocol as Etherpad
+    export under every path, with an ETag and support for If-None-Match.
+    """
+
+    def __init__(self, text: str, host="127.0.0.1", port=0, charset="utf-8"):
+        pad = self
+
+        class Handler(_PadHandler):
+            pass
+        Handler.pad = pad
+
+        self.text = text
+        self.charset = charset
+        self.requests = 0
+        self.not_modified = 0
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        return "http://{}:{}".format(*self.server.server_address)
+
+    @property
+    def etag(self) -> str:
+        return '"{}"'.format(hashlib.sha1(self.text.encode("utf-8")).hexdigest())
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _PadHandler(http.server.BaseHTTPRequestHandler):
+    pad = None
+
+    def do_GET(self):
+        self.pad.requests += 1
+        if self.headers.get("If-None-Match") == self.pad.etag:
+            self.pad.not_modified += 1
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = self.pad.text.encode(self.pad.charset)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=" + self.pad.charset)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", self.pad.etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
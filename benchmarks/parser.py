@@ -0,0 +1,68 @@
+"""
+Compares the single pass parser with the former rescanning of get_tops() and
+get_user() on synthetic protocols of increasing size.
+"""
+
+import argparse
+import os
+import re
+import tempfile
+import time
+import tracemalloc
+
+import dude
+
+from benchmarks.synthetic import write_protocol
+
+
+def rescan(path):
+    """the former approach: read all lines, find the titles, then slice and scan every TOP again"""
+    with open(path, "r") as file:
+        protocol = file.read().splitlines()
+    title_lines = [
+        i for i in range(len(protocol) - 2) if protocol[i].startswith("===") and protocol[i + 2].startswith("===")
+    ]
+    title_lines.append(len(protocol) + 1)
+    users = []
+    for i in range(len(title_lines) - 1):
+        for line in protocol[title_lines[i]:title_lines[i + 1] - 1]:
+            users += re.findall(r"\$\{(.*?)\}", line)
+    return users
+
+
+def single_pass(path):
+    return [mention.text for mention in dude.parse_file(path).mentions]
+
+
+def measure(function, path):
+    # time and memory are measured in separate runs, tracing allocations slows Python down
+    start = time.perf_counter()
+    function(path)
+    duration = time.perf_counter() - start
+    tracemalloc.start()
+    function(path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return duration, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[40, 400, 4000, 40000], help="Anzahl der TOPs")
+    parser.add_argument("--mentions", type=int, default=3, help="Erwähnungen pro TOP")
+    args = parser.parse_args()
+
+    print("{:>8} {:>10} {:>12} {:>12} {:>12} {:>12}".format(
+        "TOPs", "MiB", "rescan [s]", "rescan peak", "1-pass [s]", "1-pass peak"))
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            path = os.path.join(directory, "protocol.txt")
+            write_protocol(path, tops=size, mentions_per_top=args.mentions)
+            old_time, old_peak = measure(rescan, path)
+            new_time, new_peak = measure(single_pass, path)
+            print("{:>8} {:>10.1f} {:>12.3f} {:>11.1f}M {:>12.3f} {:>11.1f}M".format(
+                size, os.path.getsize(path) / 2 ** 20, old_time, old_peak / 2 ** 20, new_time, new_peak / 2 ** 20))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""
+Runs the real Protocol pipeline end to end on synthetic protocols against an
+in-process fake LDAP directory and a local SMTP sink. Reports throughput,
+latency percentiles per stage and operation and the peak memory as JSON, so
+results of different versions can be compared with --compare.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+import dude
+
+from benchmarks.fakes import FakeDirectory, SmtpSink
+from benchmarks.synthetic import directory_users, write_protocol
+
+
+def percentile(values: list, share: float) -> float:
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(share * (len(values) - 1))))]
+
+
+def protocol_args(path, sink, options):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("infile")
+    dude.add_options(parser)
+    return parser.parse_args([
+        path,
+        "--disable-svn",
+        "--enable-tex",
+        "--enable-mail",
+        "--disable-path-checking",
+        "--disable-cache",
+        "--unknown-users", "skip",
+        "--smtp-server", sink.address,
+        "--smtp-workers", str(options.workers),
+        "--smtp-rate", str(options.smtp_rate),
+        "--smtp-domain-rate", str(options.smtp_domain_rate),
+    ])
+
+
+def run_once(options, sink, directory):
+    """processes one freshly generated protocol, returns (seconds, mails sent)"""
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "2019-10-16.txt")
+        write_protocol(
+            path,
+            tops=options.tops,
+            mentions_per_top=options.mentions,
+            unknown_share=options.unknown,
+            external_share=options.external,
+            users=list(directory.mails),
+            seed=options.seed,
+        )
+        args = protocol_args(path, sink, options)
+        received = sink.messages
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            protocol = dude.Protocol(args, dude.LdapResolver(connection=directory))
+            dude.run(protocol, args)
+        return time.perf_counter() - start, sink.messages - received
+
+
+def benchmark(options) -> dict:
+    directory = FakeDirectory(
+        {uid: uid + "@mathphys.stura.uni-heidelberg.de" for uid in directory_users()},
+        latency=options.ldap_latency,
+    )
+    sink = SmtpSink(latency=options.smtp_latency, defer_every=options.defer_every).start()
+    dude.PROFILER.enabled = True
+    durations = []
+    mails = 0
+    events = []
+    try:
+        for _ in range(options.repeat):
+            dude.PROFILER.events = []
+            duration, sent = run_once(options, sink, directory)
+            durations.append(duration)
+            mails += sent
+            events += dude.PROFILER.events
+    finally:
+        sink.stop()
+        dude.PROFILER.enabled = False
+
+    latencies = {}
+    for event in events:
+        latencies.setdefault("{}/{}".format(event["cat"], event["name"]), []).append(event["dur"] / 1e6)
+    total = sum(durations)
+    return {
+        "version": dude.__version__,
+        "python": platform.python_version(),
+        "parameters": vars(options),
+        "runs": options.repeat,
+        "seconds": {"total": total, "p50": percentile(durations, 0.5), "max": max(durations)},
+        "throughput": {"tops_per_s": options.tops * options.repeat / total, "mails_per_s": mails / total},
+        "mails": mails,
+        "ldap_searches": directory.searches,
+        "smtp_deferrals": sink.deferred,
+        "latency": {
+            name: {
+                "count": len(values),
+                "p50": percentile(values, 0.5),
+                "p90": percentile(values, 0.9),
+                "p99": percentile(values, 0.99),
+                "max": max(values),
+            }
+            for name, values in sorted(latencies.items())
+        },
+        # ru_maxrss is given in KiB on Linux
+        "peak_rss_kib": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def compare(old: dict, new: dict):
+    """prints the change of the main figures against an older result"""
+    rows = [("TOPs/s", old["throughput"]["tops_per_s"], new["throughput"]["tops_per_s"]),
+            ("Mails/s", old["throughput"]["mails_per_s"], new["throughput"]["mails_per_s"]),
+            ("Peak RSS KiB", old["peak_rss_kib"], new["peak_rss_kib"])]
+    for name in sorted(set(old["latency"]) & set(new["latency"])):
+        rows.append((name + " p50", old["latency"][name]["p50"], new["latency"][name]["p50"]))
+    print("{:<44} {:>12} {:>12} {:>8}".format("", old["version"], new["version"], "Faktor"), file=sys.stderr)
+    for name, before, after in rows:
+        print("{:<44} {:>12.4g} {:>12.4g} {:>8.2f}".format(
+            name, before, after, after / before if before else float("nan")), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tops", type=int, default=40, help="Anzahl der TOPs pro Protokoll")
+    parser.add_argument("--mentions", type=int, default=3, help="Erwähnungen pro TOP")
+    parser.add_argument("--unknown", type=float, default=0.05, help="Anteil unbekannter Nutzer")
+    parser.add_argument("--external", type=float, default=0.1, help="Anteil externer Mailadressen")
+    parser.add_argument("--repeat", type=int, default=5, help="Anzahl der Durchläufe")
+    parser.add_argument("--workers", type=int, default=dude.SMTP_WORKERS, help="parallele SMTP Verbindungen")
+    parser.add_argument("--ldap-latency", type=float, default=0.0, help="Verzögerung pro LDAP-Suche in s")
+    parser.add_argument("--smtp-latency", type=float, default=0.0, help="Verzögerung pro Mail in s")
+    parser.add_argument("--smtp-rate", type=float, default=0.0, help="Ratenlimit des Relays, 0 = unbegrenzt")
+    parser.add_argument("--smtp-domain-rate", type=float, default=0.0, help="Ratenlimit pro Domain, 0 = unbegrenzt")
+    parser.add_argument("--defer-every", type=int, default=0, help="jede n-te Mail wird mit 451 zurückgestellt")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", help="schreibt das Ergebnis in diese Datei statt auf stdout")
+    parser.add_argument("--compare", metavar="<ergebnis.json>", help="vergleicht mit einem älteren Ergebnis")
+    options = parser.parse_args()
+
+    result = benchmark(options)
+    if options.output:
+        with open(options.output, "w") as file:
+            json.dump(result, file, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    if options.compare:
+        with open(options.compare, "r") as file:
+            compare(json.load(file), result)
+
+
+if __name__ == "__main__":
+    main()
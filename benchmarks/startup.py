@@ -0,0 +1,79 @@
+"""
+Measures the start-up cost of the main code paths of dude.py in fresh
+interpreters: wall time, time spent importing and which of the expensive
+modules (LDAP, SMTP, e-mail, HTTP, SQLite) got loaded at all.
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.synthetic import write_protocol
+
+DUDE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "dude.py")
+
+HEAVY_MODULES = ["ldap", "smtplib", "email.mime.multipart", "urllib.request", "sqlite3", "difflib", "tempfile"]
+
+IMPORT_RE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$")
+
+DRY_RUN = ["--disable-mail", "--disable-svn", "--disable-path-checking", "--disable-cache", "--offline",
+           "--unknown-users", "skip"]
+
+CODE_PATHS = [
+    ("import dude", ["-c", "import dude"]),
+    ("--version", [DUDE, "--version"]),
+    ("Probelauf", [DUDE, "{protocol}", "--disable-tex"] + DRY_RUN),
+    ("nur .tex", [DUDE, "{protocol}", "--enable-tex"] + DRY_RUN),
+]
+
+
+def measure(command, folder):
+    """runs one interpreter, returns (wall seconds, import seconds, imported modules)"""
+    environment = dict(os.environ, XDG_CACHE_HOME=folder, PYTHONPATH=os.path.dirname(DUDE))
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, "-X", "importtime"] + command,
+        cwd=folder, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+    )
+    wall = time.perf_counter() - start
+    imports = 0
+    modules = set()
+    for line in process.stderr.splitlines():
+        match = IMPORT_RE.match(line)
+        if match:
+            modules.add(match.group(4))
+            if not match.group(3):
+                # only top level imports, their time includes the nested ones
+                imports += int(match.group(2))
+    return wall, imports / 1e6, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=5, help="Anzahl der Durchläufe pro Pfad")
+    parser.add_argument("--tops", type=int, default=40, help="Anzahl der TOPs des Testprotokolls")
+    options = parser.parse_args()
+
+    print("{:<12} {:>10} {:>12} {:>8}  {}".format("Pfad", "Wall [ms]", "Import [ms]", "Module", "teure Module"))
+    with tempfile.TemporaryDirectory() as folder:
+        protocol = os.path.join(folder, "2019-10-16.txt")
+        for name, command in CODE_PATHS:
+            walls, imports = [], []
+            for _ in range(options.repeat):
+                write_protocol(protocol, tops=options.tops)
+                wall, imported, modules = measure([part.format(protocol=protocol) for part in command], folder)
+                walls.append(wall)
+                imports.append(imported)
+            heavy = [module for module in HEAVY_MODULES if module in modules]
+            print("{:<12} {:>10.1f} {:>12.1f} {:>8}  {}".format(
+                name, statistics.median(walls) * 1e3, statistics.median(imports) * 1e3, len(modules),
+                ", ".join(heavy) or "-"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""generates synthetic protocols of configurable size"""
+
+import random
+
+USERS = ["kai-uwe", "chrisb", "johannes", "max", "erika", "finanzen", "fsr", "social"]
+
+WORDS = "Die Fachschaft beschließt nach kurzer Diskussion den Antrag mit leichten Bedenken umzusetzen".split()
+
+
+def directory_users(count=30):
+    """uids known to the fake directory, the first ones are those of USERS"""
+    return [user for user in USERS if user not in ("finanzen", "fsr", "social")] + \
+        ["mitglied{}".format(k) for k in range(count)]
+
+
+def generate_protocol(tops=40, mentions_per_top=3, body_lines=10, unknown_share=0.0, external_share=0.0,
+                      users=None, seed=0):
+    """
+    yields the lines of a protocol with the given number of TOPs and mentions,
+    a share of the mentions are unknown users or external mail addresses
+    """
+    rng = random.Random(seed)
+    users = users or USERS
+    yield ""
+    yield "Simo: Johannes"
+    yield "Protokoll: Max ${max}"
+    yield "Beginn: 18:15 Uhr"
+    yield "Ende: 20:03 Uhr"
+    yield ""
+    for number in range(1, tops + 1):
+        title = "TOP {}: {}".format(number, " ".join(rng.sample(WORDS, 3)))
+        yield "=" * len(title)
+        yield title
+        yield "=" * len(title)
+        mention_lines = [rng.randrange(body_lines) for _ in range(mentions_per_top)]
+        for line in range(body_lines):
+            text = " ".join(rng.choice(WORDS) for _ in range(12))
+            for _ in range(mention_lines.count(line)):
+                draw = rng.random()
+                if draw < unknown_share:
+                    mention = "unbekannt{}".format(rng.randrange(1000))
+                elif draw < unknown_share + external_share:
+                    mention = "extern{}@example.org".format(rng.randrange(1000))
+                else:
+                    mention = rng.choice(users)
+                text += " ${" + mention + "}"
+            yield text
+        yield ""
+
+
+def write_protocol(path, **kwargs):
+    with open(path, "w") as file:
+        for line in generate_protocol(**kwargs):
+            file.write(line + "\n")
@@ -5,32 +5,87 @@
 #     ${internal}          => internal@mathphys.stura.uni-heidelberg.de
 #     ${external@some.com} => external@some.com
 
+# Only cheap modules are imported here. Network, mail, database and LDAP
+# modules are imported by the functions that need them, so that dry runs,
+# tex-only runs and --version start quickly.
 from string import Template
 import argparse
 import configparser
 import datetime
 import subprocess
 import re
-import smtplib
-import getpass
-import tempfile
-import locale
-import urllib.request
 import sys
 import os
-import socket
-
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-
-import ldap
+import threading
+import time
+import hashlib
+import json
+import collections
+import glob
+import contextlib
+import array
+import bisect
+import heapq
 
 __version__ = "v4.1.2"
 
 MATHPHYS_LDAP_ADDRESS = "ldap1.mathphys.stura.uni-heidelberg.de"
 MATHPHYS_LDAP_BASE_DN = "ou=People,dc=mathphys,dc=stura,dc=uni-heidelberg,dc=de"
-
-locale.setlocale(locale.LC_TIME, 'de_DE')
+# group entries with the members of the mailing lists
+MATHPHYS_LDAP_GROUP_DN = "ou=Group,dc=mathphys,dc=stura,dc=uni-heidelberg,dc=de"
+# value of ldap.SCOPE_SUBTREE, python-ldap is only imported when connecting
+LDAP_SCOPE_SUBTREE = 2
+# attributes of a group entry with its members: uids, DNs and external addresses
+LDAP_MEMBER_ATTRIBUTES = ("memberUid", "member", "rfc822MailMember")
+# maximum number of uids combined into a single OR filter
+LDAP_CHUNK_SIZE = 50
+
+MATHPHYS_SMTP_ADDRESS = "mail.mathphys.stura.uni-heidelberg.de"
+URZ_SMTP_ADDRESS = "mail.urz.uni-heidelberg.de"
+# number of parallel SMTP connections and delivery attempts per mail
+SMTP_WORKERS = 4
+SMTP_RETRIES = 5
+SMTP_TIMEOUT = 30
+# token bucket limits in mails per second for the relay and for every recipient domain,
+# bursts of twice the rate are allowed, 0 disables a limit
+SMTP_RATE = 10.0
+SMTP_DOMAIN_RATE = 5.0
+
+# minimal similarity for accepting a suggestion for an unknown user automatically
+AUTO_ACCEPT_SCORE = 0.8
+
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "protocoldude")
+# lifetime of cached LDAP results in days; unknown uids are forgotten sooner
+CACHE_TTL = 30
+CACHE_NEGATIVE_TTL = 1
+# downloaded protocols are kept with their ETag/Last-Modified for conditional requests
+DOWNLOAD_DIR = os.path.join(CACHE_DIR, "downloads")
+DOWNLOAD_TIMEOUT = 10
+DOWNLOAD_RETRIES = 3
+
+# a protocol is finished once its 'Ende:' header has a time, 'dude.py watch' waits for that
+WATCH_COMPLETE = r"(?m)^Ende:\s*\d{1,2}[:.]\d{2}"
+# seconds without further changes before a saved protocol is processed, and polling interval without inotify
+WATCH_DEBOUNCE = 0.3
+WATCH_POLL = 1.0
+
+# month names for the date of the .tex template, independent of the process locale
+GERMAN_MONTHS = [
+    "Januar", "Februar", "März", "April", "Mai", "Juni",
+    "Juli", "August", "September", "Oktober", "November", "Dezember",
+]
+
+MENTION_RE = re.compile(r"\$\{(.*?)\}")
+HEADER_RE = re.compile(r"^(Simo|Protokoll|Beginn|Ende):\s*(.*?)\s*$")
+
+# templates of the mails, compiled once
+MAIL_SUBJECT = Template("$prefix - $title")
+DIGEST_SUBJECT = Template("$prefix - $count TOPs")
+MAIL_BODY = Template(
+    "$salutation,\n\nDu sollst über irgendwas informiert werden. Im Sitzungsprotokoll steht dazu folgendes:"
+    "\n\n$content\n\n\nViele Grüße, Dein SPAM-Skript."
+)
+DIGEST_SEPARATOR = "\n\n\n"
 
 # define common mail lists and aliases
 LIST_USERS = {
@@ -66,100 +121,60 @@ LIST_USERS = {
     "finanzen": "Sehr geehrte Menschen mit Ahnung der vielen Goldbarren",
     "vorkurs": "Lieber AK Vorkurs",
 }
+LIST_DOMAIN = "mathphys.stura.uni-heidelberg.de"
 
-vorlage = Template(r"""% !TEX program    = pdflatex
-% !TEX encoding   = UTF-8
-% !TEX spellcheck = de_DE
-
-\documentclass[11pt, fachschaft=mathphys,twosided=true]{mathphys/mathphys-article}
-\usepackage[utf8]{inputenc}
-\usepackage[ngerman]{babel}
-\usepackage[T1]{fontenc}
-\usepackage{eurosym}
-\usepackage{booktabs}
-\renewcommand\thesection{TOP \arabic{section}:}
-\renewcommand*\thesubsection{TOP \arabic{section}.\arabic{subsection}:}
-\renewcommand\contentsname{Tagesordnung}
-\newenvironment{antrag}{\begin{quote}\begin{itshape}}{\end{itshape}\end{quote}}
-\usepackage{hyperref}
-%-------------------------------------------------
-% Konsensvorlagen (ggf. anpassen!)
-%-------------------------------------------------
-\newcommand{\konsens}[1]{In der Fachschaftssitzung MathPhysInfo, sowie in den anwesenden Fachschaftsräten, besteht Konsens ohne Bedenken.\\} % immer die Anzahl der Anwesenden anpassen!
-\newcommand{\konsensLB}[1]{In der Fachschaftssitzung MathPhysInfo, sowie in den anwesenden Fachschaftsräten, besteht Konsens mit leichten Bedenken.\\} % immer die Anzahl der Anwesenden anpassen!
-\newcommand{\konsensE}[1]{In der Fachschaftssitzung MathPhysInfo, sowie in den anwesenden Fachschaftsräten, besteht Konsens mit Enthaltung.\\} % immer die Anzahl der Anwesenden anpassen!
-\newcommand{\konsensFsrPhys}{Die Fachschaftsratssitzung Physik entscheidet einstimmig, den Beschluss entsprechend der Entscheidung der Fachschaftssitzung MathPhysInfo umzusetzen.\\}
-% \newcommand{\konsensFsrMathe}{Die Fachschaftsratssitzung Mathematik entscheidet einstimmig, den Beschluss entsprechend der Entscheidung der Fachschaftssitzung MathPhysInfo umzusetzen.\\}
-\newcommand{\konsensFsrInfo}{Die Fachschaftsratssitzung Informatik entscheidet einstimmig, den Beschluss entsprechend der Entscheidung der Fachschaftssitzung MathPhysInfo umzusetzen.\\}
-
-\setlength{\parindent}{0pt}
-\setlength{\parskip}{1em}
-
-\begin{document}
-\date{\vspace{-2em} $datum \vspace{-1em}} % Datum ersetzen
-\title{\vspace{-2em}Vorläufiges Protokoll der Fachschaftssitzung MathPhysInfo}
-\maketitle
-
-\begin{tabbing}
-    \textbf{Sitzungsmoderation:}\quad\=Kai-Uwe \\% SiMo einfügen
-    \textbf{Protokoll:}\> Max Müller \\% Protokoll einfügen
-    \textbf{Beginn:}\>18:15 Uhr\\
-    \textbf{Ende:}\>xx:xx Uhr\\ % Sitzungsende einfügen
-\end{tabbing}
-
-\section{Begrüßung}
-    Die Sitzungsmoderation begrüßt die anwesenden Mitglieder der Studienfachschaften Mathematik, Physik und Informatik und eröffnet so die Fachschaftsvollversammlung der Studienfachschaften Mathematik, Physik und Informatik.
-
-\section{Feststellung der Beschlussfähigkeiten}
-    Fachschaftsrat Physik, Mathe und Informatik sind alle Beschlussfähig.
-
-\section{Beschluss des Protokolls der letzten Sitzung}
-
-\begin{antrag}
-    Annahme des Protokolls vom xx. Monat 2019. \\% Datum einfügen
-\end{antrag}
-\konsensE{}
-
-\section{Feststellen der Tagesordnung}
-\begin{antrag}
-    Die Tagesordnung wird in der vorliegenden Form angenommen.
-\end{antrag}
-\konsens{}
-
-\section{Sitzungsmoderation für die nächste Sitzung}
-    Die Sitzungsmoderation für die Fachschaftssitzung MathPhysInfo der nächsten Woche wird von xxx übernommen. % SiMo nachste Woche einfugen
-
-%%%% Achte ab hier darauf, dass Dopplungen der Standard TOPs gelöscht werden. %%%%
-$sections
-
-\emph{Die Sitzungmoderation schließt die Sitzung um xx:xx Uhr.}
-\end{document}
-""")
+# templates of the official protocol (vorlage.tex, vorlage.md, vorlage.html)
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config")
+# local members of the mailing lists, used instead of the LDAP group entries
+LIST_MEMBERS_FILE = os.path.join(TEMPLATE_DIR, "listen.ini")
 
 
 class Protocol(object):
     """reads in the protocol and processes it"""
 
-    def __init__(self, args):
+    def __init__(self, args, resolver=None):
         # validate filename as protocol (yyyy-mm-dd) and .txt
         self.args = args
         self.path = args.infile
+        self.resolver = resolver if resolver is not None else LdapResolver()
 
         print('\nProtokoll "{}" wird bearbeitet ..\n'.format(self.path))
 
-        if "http" in self.path:
+        if is_url(self.path):
             self.protocol = self.download_protocol(self.path)
-            splitted = self.path.split("/")
+            splitted = self.path.rstrip("/").split("/")
             self.path = splitted[len(splitted)-1]+'.txt'
         else:
-            with open(self.path, "r") as file:
-                self.protocol = file.read().splitlines()
+            self.protocol = ProtocolBuffer.from_file(self.path)
         self.tops = []
+        self.document = None
+        # changed lines (line index -> text) and the marker, applied when writing
+        self.edits = {}
+        self.marker = None
         self.mails_sent = False
         self.unknown = []
+        # (top, recipient) pairs already reached through a mentioned mailing list
+        self.covered = []
+        self.outbox = None
+        self.renderer = MessageRenderer(args)
+        # send mails again that were already sent by a previous run
+        self.resend = False
+        # only send mails for TOPs changed since the last run
+        self.incremental = False
+
+    def changed_on_disk(self) -> bool:
+        """checks whether the protocol file changed since it was read, e.g. by the VCS update"""
+        source = self.protocol.source
+        if source is None or source[0] != os.path.abspath(self.path):
+            return False
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return (stat.st_size, stat.st_mtime_ns) != source[1:]
 
     def check_dude(self) -> bool:
-        return ":Protocoldude:" in self.protocol[0]
+        return bool(self.protocol) and ":Protocoldude:" in self.protocol[0]
 
     def check_path(self) -> bool:
         """
@@ -191,13 +206,13 @@ class Protocol(object):
         return True
 
 
-    def download_protocol(self, url, save_path=""):
+    def download_protocol(self, url):
         """
         Downloads a protocol
         URL: The URL to download the Protocol from
         """
         export_suffix = ""
-        if "pad" in url:
+        if "pad" in url and not url.rstrip("/").endswith("/export/txt"):
             export_suffix = "/export/txt"
         # if "notes" in url:
             # import kerberos
@@ -207,145 +222,270 @@ class Protocol(object):
             # negotiate_details = kerberos.authGSSClientResponse(krb_context)
             # headers = {"Authorization": "Negotiate " + negotiate_details}
             # print(headers)
-        if not save_path:
-            save_path = tempfile.NamedTemporaryFile()
-            urllib.request.urlretrieve(url+export_suffix, save_path.name)
-            with save_path.file as f:
-                protocol = [line.decode("utf-8") for line in f.read().splitlines()]
-            print(save_path.name)
-            return protocol
-        else:
-            urllib.request.urlretrieve(url, save_path)
+        downloader = Downloader(timeout=self.args.download_timeout)
+        return ProtocolBuffer.from_file(downloader.fetch(url.rstrip("/") + export_suffix))
 
     def get_tops(self):
         """separate the given protocol in several TOPs from '===' to '==='"""
-        title_lines = []
-
-        for i in range(len(self.protocol) - 2):
-            line_a = self.protocol[i]
-            line_b = self.protocol[i + 2]
-
-            if line_a.startswith("===") and line_b.startswith("==="):
-                title_lines.append(i)
-
-        title_lines.append(len(self.protocol) + 1)
-
-        for i in range(len(title_lines) - 1):
-            begin = title_lines[i]
-            end = title_lines[i+1] - 1
-            top = TOP(i + 1, begin, end, self.protocol, self.args)
-            self.tops.append(top)
+        with PROFILER.span("get_tops", "parse"):
+            self.document = parse_protocol(self.protocol)
+            for span in self.document.tops:
+                self.tops.append(TOP(span.number, span.start, span.end, self.protocol, self.document.mentions))
 
     def rename_title(self):
         """Adjust TOP title type setting"""
         for top in self.tops:
-            top.rename()
+            self.edits.update(top.rename())
 
-    def get_users(self):
+    def get_users(self, ready=None):
+        """resolves the mentioned users of all TOPs, ready is called with every finished TOP"""
+        with PROFILER.span("get_users", "resolve"):
+            for top in self.tops:
+                top.get_user()
+            # resolve all mentioned users at once instead of one query per mention
+            self.resolver.resolve([user for top in self.tops for user in top.users])
+            failures = list(dict.fromkeys(
+                user for top in self.tops for user in top.users if resolve_user(user, self.resolver) is None
+            ))
+        corrections = self.correct_unknown(failures)
+        if self.args.list_dedup != "off":
+            # the members of all mentioned lists at once
+            self.resolver.load_members([user for top in self.tops for user in top.users if is_list(user)])
         for top in self.tops:
-            top.get_user()
-            self.unknown = top.get_mails()
+            self.unknown += top.get_mails(self.resolver, corrections)
+            if self.args.list_dedup != "off":
+                self.collapse(top)
+            if ready is not None:
+                ready(top)
+        if self.covered:
+            self.report_covered()
+
+    def collapse(self, top):
+        """drops the recipients of a TOP that get it through a mailing list anyway, with --list-dedup=skip"""
+        covered = self.resolver.covered(top.recipients)
+        self.covered += [(top, recipient) for recipient in covered]
+        if covered and self.args.list_dedup == "skip":
+            top.recipients = [recipient for recipient in top.recipients if recipient not in covered]
+
+    def report_covered(self):
+        if self.args.digest:
+            # a digest is only saved if none of its TOPs is left for the address
+            remaining = {address for top in self.tops for _, address in top.recipients}
+            saved = len({address for _, (_, address) in self.covered} - remaining)
+        else:
+            saved = len(self.covered)
+        names = ", ".join(dict.fromkeys(user for _, (user, _) in self.covered))
+        if self.args.list_dedup == "skip":
+            print("{} Mails eingespart, die Empfänger bekommen die TOPs schon über eine Mailing-Liste: {}".format(
+                saved, names))
+        else:
+            print("{} Mails könnten mit --list-dedup=skip eingespart werden, die Empfänger bekommen die TOPs"
+                  " schon über eine Mailing-Liste: {}".format(saved, names))
+
+    def correct_unknown(self, failures: list) -> dict:
+        """
+        Finds replacements for all unresolvable users at once, depending on
+        --unknown-users by asking, skipping, failing or accepting the best
+        suggestion.
+        """
+        if not failures:
+            return {}
+        policy = self.args.unknown_policy
+        if policy == "fail":
+            raise LookupError("Unbekannte Empfänger: {}".format(", ".join(failures)))
+        if policy == "skip":
+            print("Unbekannte Empfänger werden übersprungen: {}".format(", ".join(failures)))
+            return {}
+
+        index = SuggestionIndex(list(LIST_USERS) + self.resolver.known_uids())
+        suggestions = {user: index.suggest(user) for user in failures}
+        corrections = {}
+        if policy == "auto":
+            for user in failures:
+                if suggestions[user] and suggestions[user][0][1] >= self.args.auto_accept:
+                    corrections[user] = suggestions[user][0][0]
+                    print('"{}" wird durch "{}" ersetzt.'.format(user, corrections[user]))
+                else:
+                    print('"{}" ist kein Nutzer und keine bekannte Mailing-Liste und wird übersprungen.'.format(user))
+            return corrections
+
+        print("\nFolgende Empfänger sind keine Nutzer und keine bekannten Mailing-Listen:")
+        for user in failures:
+            proposals = ", ".join("{}) {}".format(k + 1, name) for k, (name, _) in enumerate(suggestions[user]))
+            print('    - "{}"{}'.format(user, "  Vorschläge: " + proposals if proposals else ""))
+        print("Gib für jeden eine Nummer, einen anderen Empfänger oder 'q' zum Überspringen ein.")
+        for user in failures:
+            while True:
+                answer = input('"{}": '.format(user)).strip()
+                if answer in ("", "q"):
+                    break
+                if answer.isdigit() and 0 < int(answer) <= len(suggestions[user]):
+                    answer = suggestions[user][int(answer) - 1][0]
+                if resolve_user(answer, self.resolver) is not None:
+                    corrections[user] = answer
+                    break
+                print('"{}" ist auch kein Nutzer und keine bekannte Mailing-Liste.'.format(answer))
+        return corrections
+
+    def send_mails(self, connect=None):
+        """
+        Resolves the users and sends the mails of every TOP as soon as its
+        recipients are known, while the following TOPs are still processed.
+        """
+        if connect is None:
+            connect = SmtpConnector(self.args.smtp_server)
+        delivery = create_delivery(self.args, connect, self.mail_result)
+        delivery.start()
+        pending = []
+
+        def submit(tops):
+            for mail in self.queue_mails(tops) or []:
+                pending.append(mail)
+                delivery.submit(mail)
 
-    def send_mails(self):
-        if sum([len(top.mails) for top in self.tops])==0:
-            return
         try:
-            try:
-                server = smtplib.SMTP("mail.mathphys.stura.uni-heidelberg.de", 25, timeout=3)
-            except socket.timeout as _:
-                success = False
-                while not success:
-                    try:
-                        server = smtplib.SMTP("mail.urz.uni-heidelberg.de", 587)
-                        server.starttls()
-                        username = input("Uni ID für den Mailversand: ")
-                        prompt = "Passwort für {}: ".format(username)
-                        server.login(username, getpass.getpass(prompt=prompt))
-                        success = True
-                    except smtplib.SMTPAuthenticationError:
-                        print("\nDu hast die falschen Anmeldedaten eingegeben!")
-                        print("Bitte versuche es noch einmal:")
-
-            mailcount = 0
-            print(len(self.tops))
-            for top in self.tops:
-                mailcount += top.send_mail(server)
-            server.quit()
-            self.mails_sent = True
-            if mailcount == 1:
-                print("\nEs wurde erfolgreich eine Mail versendet!\n")
+            if self.args.digest:
+                # a digest needs the recipients of all TOPs
+                self.get_users()
+                submit(self.tops)
             else:
-                print("\nEs wurden erfolgreich {} Mails verschickt.\n".format(mailcount))
-            # if self.unknown:
-            #     print("An folgende Nutzer konnte aus unerklärlichen Gründen keine Mail versandt werden:")
-            #     for user in self.unknown:
-            #         print("    - {}".format(user))
-        except Exception as exception:
-            print(exception)
-            print("\nMails konnten nicht verschickt werden.")
+                self.get_users(ready=lambda top: submit([top]))
+        finally:
+            results = delivery.finish()
+        if pending:
+            self.report_mails(results, len(pending))
+            print(delivery.stats())
+
+    def queue_mails(self, tops=None):
+        """prepares the mails of the given (or all) TOPs and returns those not sent by an earlier run"""
+        mails = self.renderer.render(self.tops if tops is None else tops)
+        if not mails:
+            return None
+        if self.outbox is None:
+            self.outbox = Outbox(outbox_path(self.path))
+            if self.resend:
+                self.outbox.reset()
+        pending = [mail for mail in mails if self.outbox.state(mail) not in (Outbox.SENT, Outbox.SPOOLED)]
+        if len(pending) < len(mails):
+            print("{} Mails wurden bereits bei einem früheren Aufruf verschickt und werden übersprungen.".format(
+                len(mails) - len(pending)))
+        self.outbox.record_many(pending, Outbox.QUEUED)
+        return pending
+
+    def report_mails(self, results, expected):
+        failed = [result for result in results if not result.ok]
+        mailcount = len(results) - len(failed)
+        for top in self.tops:
+            top.send = sum(1 for result in results if result.ok and top in result.mail.tops)
+        if self.args.spool:
+            print("\nEs wurden {} Mails in den Spool geschrieben.\n".format(mailcount))
+        elif mailcount == 1:
+            print("\nEs wurde erfolgreich eine Mail versendet!\n")
+        else:
+            print("\nEs wurden erfolgreich {} Mails verschickt.\n".format(mailcount))
+        if failed:
+            print("An folgende Empfänger konnte keine Mail versandt werden:")
+            for result in failed:
+                print('    - "{}" zu {}: {}'.format(result.mail.user, result.mail.subject, result.error))
+            print("\nMails konnten nicht vollständig verschickt werden.")
+        self.mails_sent = not failed and len(results) == expected
+
+    def mail_result(self, result):
+        state = Outbox.SPOOLED if self.args.spool else Outbox.SENT
+        self.outbox.record(result.mail, state if result.ok else Outbox.FAILED, result.error)
+        if result.ok and not self.args.spool:
+            print('Mail an "{}" zu {} gesendet.'.format(result.mail.user, result.mail.title))
+
+    def select_changed(self) -> int:
+        """
+        Compares the TOPs with the fingerprints of the last run. Unchanged TOPs
+        only keep newly mentioned users, so they cost no LDAP or SMTP work.
+        """
+        with open(sidecar_path(self.path, "fingerprints"), "r") as file:
+            fingerprints = json.load(file)
+        changed = 0
+        for key, top in self.keyed_tops():
+            old = fingerprints.get(key)
+            if old is not None and old["content"] == top.content_hash():
+                top.known_users = set(old["recipients"])
+            else:
+                changed += 1
+        return changed
+
+    def save_fingerprints(self):
+        fingerprints = {
+            key: {"content": top.content_hash(), "recipients": top.mentioned_users()}
+            for key, top in self.keyed_tops()
+        }
+        with open(sidecar_path(self.path, "fingerprints"), "w") as file:
+            json.dump(fingerprints, file, ensure_ascii=False, indent=1)
+
+    def has_fingerprints(self) -> bool:
+        return os.path.isfile(sidecar_path(self.path, "fingerprints"))
+
+    def keyed_tops(self):
+        """TOPs keyed by their title without number, repeated titles are counted"""
+        seen = collections.Counter()
+        for top in self.tops:
+            title = top.title.plain_text()
+            seen[title] += 1
+            yield "{}#{}".format(title, seen[title]), top
 
     def write_success(self):
         if self.mails_sent:
+            # before the marker shifts the line numbers of the TOPs
+            self.save_fingerprints()
             now = datetime.datetime.now()
-            self.protocol.insert(
-                0,
-                ":Protocoldude: Mails versandt @ {}".format(
-                    now.strftime("%H:%M %d.%m.%Y")
-                ),
-            )
-            self.protocol.insert(1, "\n")
-
-        with open(self.path, "w") as file:
-            file.write("\n".join(self.protocol) + "\n")
-
-    def svn_interaction(self):
-        # TODO: more specific exception handling
-        try:
-            subprocess.run(["svn", "up"], check=True)
-            subprocess.run(["svn", "add", "{}".format(self.path)], check=True)
-            if not self.args.disable_tex:
-                subprocess.run(["svn", "add", "{}".format(self.path[:-3] + "tex")], check=True)
-            subprocess.run(
-                [
-                    "svn",
-                    "commit",
-                    "-m",
-                    "Protokoll der {} hinzugefügt".format(self.args.mail_subject_prefix),
-                ],
-                check=True,
-            )
-            print(
-                "Protokoll bearbeitet und in den Sumpf geschrieben.\n Für heute hast du's geschafft!"
-            )
-        except:
-            print(
-                "Konnte SVN Update nicht durchführen. \n Das musst Du irgendwie von Hand reparieren mit 'svn cleanup' oder so."
-            )
-            print("Das Protokoll wurde trotzdem bearbeitet und gespeichert.")
+            self.marker = ":Protocoldude: Mails {} @ {}".format(
+                "gespoolt" if self.args.spool else "versandt", now.strftime("%H:%M %d.%m.%Y"))
 
-    def official(self):
+        header = []
+        if self.marker is not None:
+            if self.check_dude():
+                self.edits[0] = self.marker
+            else:
+                header = [self.marker, "", ""]
+        with PROFILER.span("write_success", "io"):
+            write_protocol(self.path, self.protocol, self.edits, header)
+
+    def generated_files(self) -> list:
+        """the protocol and the files created from it, for the version control"""
+        paths = [self.path]
+        if not self.args.disable_tex:
+            paths.append(self.output_path())
+            pdf = self.path[:-4] + ".pdf"
+            if self.args.build_pdf and os.path.isfile(pdf):
+                paths.append(pdf)
+        return paths
+
+    def svn_interaction(self, vcs):
+        publish(vcs, self.generated_files(), "Protokoll der {} hinzugefügt".format(self.args.mail_subject_prefix))
+
+    def official(self, pdf=True):
         """
-        Create official protocol as yyy-mm-dd.tex file. Use the TOP titles as section names.
+        Create official protocol as yyy-mm-dd.tex file (or .md/.html with --format)
+        from the template in config/. Use the TOP titles as section names and
+        their content as the text of the sections.
         """
+        backend = OUTPUT_BACKENDS[self.args.output_format](self.args.template_dir)
+        path = self.output_path()
+        # rendered completely first, an error keeps an existing (maybe edited) file as it is
+        replace_file(path, backend.render(self))
+        if pdf and self.args.build_pdf and backend.extension == "tex":
+            build_pdf(path)
 
-        date = datetime.datetime.strptime(self.path.split(".")[0], "%Y-%m-%d").strftime("%d. %B %Y")
-
-        section = ""
-        for top in self.tops[:]:
-            top.title.title_text = top.title.title_text.replace("&", "\\&")
-            section += "\\section{" + top.title.title_text[top.title.title_text.find(":")+2:] + "}\n\n"
-
-        einladung = vorlage.substitute(datum= date, sections= section)
-
-        with open((self.path[:-4] + '.tex'), 'w') as f:
-            f.write(einladung)
+    def output_path(self) -> str:
+        return self.path[:-4] + "." + OUTPUT_BACKENDS[self.args.output_format].extension
 
     def remind(self):
         for line in self.protocol[:5]:
             if "protokoll" in line.lower():
-                user = re.findall(r"\$\{(.*?)\}", line)[0]
-                if len(extract_mails(ldap_search([user], [])))>0:
-                    mail = extract_mails(ldap_search([user], []))[0]
+                user = MENTION_RE.findall(line)[0]
+                mail = self.resolver.lookup(user)
+                if mail:
+                    import smtplib
+                    from email.mime.multipart import MIMEMultipart
+                    from email.mime.text import MIMEText
 
                     server = smtplib.SMTP("mail.mathphys.stura.uni-heidelberg.de", 25)
                     msg = MIMEMultipart()
@@ -365,309 +505,3447 @@ class Protocol(object):
         print("Eine Erinnerung an den Protokollanten konnte nicht verschickt werden. Denke selber dran, das offizielle Protokoll zu erstellen. Eine Vorlage liegt bereits in diesem Ordner.")
         return
 
-class TOP(Protocol):
+class TOP(object):
     """
-    Separates the several TOPs out of one protocol and provides different
-    functions to further process the sections.
+    A TOP as a view on the lines start to end of the protocol. Provides
+    different functions to further process the sections.
     """
 
-    def __init__(self, number: int, start: int, end: int, protocol, args):
-        self.args = args
+    __slots__ = ("number", "start", "end", "lines", "mentions", "title", "users", "recipients", "send",
+                 "known_users")
+
+    def __init__(self, number: int, start: int, end: int, lines, mentions=None):
         self.number = number
         self.start = start
         self.end = end
+        # shared by all TOPs of a protocol, never changed
+        self.lines = lines
+        self.mentions = mentions
+        self.title = TOP_Title(start, start+3, lines[start+1])
+        # mentioned users, replaced by their names once resolved
         self.users = []
-        self.unknown = []
-        self.mails = []
-        self.protocol = protocol
-        self.title = TOP_Title(start, start+3, self.protocol[start+1])
+        # (name, mail) of every resolved user
+        self.recipients = []
         self.send = 0
+        # users already informed about the unchanged content of this TOP
+        self.known_users = frozenset()
 
     def __str__(self):
-        return "\n".join(self.protocol[self.start:self.end])
+        return "\n".join(self.title.list() + self.lines[self.title.end:self.end])
 
-    def rename(self):
+    def rename(self) -> dict:
+        """renames the title and returns the changed lines of the protocol"""
         self.title.rename(self.number)
-        # apply the changes in the title to the protocol
-        title = self.title.list()
-        for p_index, t_index in zip(range(self.title.start, self.title.end), range(len(title))):
-            self.protocol[p_index] = title[t_index]
+        return dict(zip(range(self.title.start, self.title.end), self.title.list()))
 
     def get_user(self):
-        """searches for all mentioned users in the TOP paragraph"""
-        users = []
-        for line in self.protocol[self.start:self.end]:
-            # check for mail address
-            adress = re.findall(r"\$\{(.*?)\}", line)
-            users += adress
-        self.users = list(set(users))  # remove duplicates
-
-    def get_mails(self):
-        mailinglistusers = []
+        """collects all mentioned users in the TOP paragraph"""
+        self.users = [user for user in self.mentioned_users() if user not in self.known_users]
+
+    def mentioned_users(self) -> list:
+        if self.mentions is None:
+            texts = parse_protocol(self.lines[self.start:self.end]).mentions.text
+        else:
+            texts = self.mentions.texts(self.number - 1)
+        # remove duplicates but keep the order of the protocol
+        return list(dict.fromkeys(texts))
+
+    def content_hash(self) -> str:
+        """hash of the TOP body without its title and without the mentions"""
+        content = hashlib.sha256()
+        for line in self.lines[self.title.end:self.end]:
+            content.update(" ".join(MENTION_RE.sub("", line).split()).encode("utf-8") + b"\n")
+        return content.hexdigest()
+
+    def get_mails(self, resolver, corrections) -> list:
+        """resolves the users to (name, mail) recipients and returns the unknown ones"""
         print(self.title)
+        unknown = []
 
         for k, user in enumerate(self.users):
-            # if user in LDAP oder LIST_USERS append valid mail to "mails"
-            # else wait for adjustet input or interruption
-            result = extract_mails(ldap_search([user], self.unknown)) # search remaining users in LDAP
+            # if user in LDAP, LIST_USERS or a mail address add the recipient
+            # else use the replacement chosen for unknown users
+            result = resolve_user(user, resolver)
+            if result is None and user in corrections:
+                result = resolve_user(corrections[user], resolver)
             if result:
-                self.mails.append(result[0])
-            elif user.lower() in LIST_USERS:
-                self.mails.append(user + "@mathphys.stura.uni-heidelberg.de")
-            elif re.match("[^@]+@[^@]+\.[^@]+", user):
-                if ' ' in user:
-                    name = " ".join([u for u in user.split() if not '@' in u])
-                    mail = [u for u in user.split() if '@' in u][0]
-                    self.users[k] = name
-                    self.mails.append(mail)
-                else: # user is valid mail address
-                    self.users[k] = user.split('@')[0]
-                    self.mails.append(user)
+                self.users[k] = result[0]
+                self.recipients.append(result)
             else:
-                new_name = user
-                while not result and new_name !='q': # loop until correct user or stopping condition entered
-                    print('\n"{}" ist kein Nutzer und keine bekannte Mailing-Liste.'.format(new_name))
-                    new_name = input("Bitte gib den korrektren Mailempfanger ein oder uberspringe mit 'q': ")
-                    result = extract_mails(ldap_search([new_name], self.unknown)) # search remaining users in LDAP
-                    if not result and user.lower() in LIST_USERS:
-                        result = new_name + "@mathphys.stura.uni-heidelberg.de"
-                if result:
-                    self.mails.append(result)
-                else:
-                    self.unknown.append(user)
-                    self.mails.append([])
+                unknown.append(user)
 
-#            print("User: {} - Mail: {}\n".format(user, self.mails[k]))
         print("\n")
+        return unknown
+
+
+class MessageRenderer(object):
+    """
+    Renders the mails of a protocol from the precompiled MAIL_* templates.
+    The content of every TOP is rendered once and shared by all recipients.
+    In digest mode all TOPs for the same address are merged into one mail.
+    """
+
+    def __init__(self, args):
+        self.prefix = args.mail_subject_prefix
+        self.from_address = args.from_address
+        self.digest = args.digest
+        # the protocol the mails belong to, part of their Message-ID
+        self.origin = os.path.basename(args.infile.rstrip("/"))
+        self.contents = {}
+
+    def content(self, top) -> str:
+        if top not in self.contents:
+            self.contents[top] = str(top)
+        return self.contents[top]
+
+    def render(self, tops) -> list:
+        """creates the mails for all resolved recipients of the given TOPs"""
+        recipients = collections.OrderedDict()
+        for top in tops:
+            for user, address in top.recipients:
+                key = address if self.digest else (top, address)
+                recipients.setdefault(key, (user, address, []))[2].append(top)
+        return [self.mail(user, address, tops) for user, address, tops in recipients.values()]
+
+    def mail(self, user, address, tops):
+        if len(tops) == 1:
+            subject = MAIL_SUBJECT.substitute(prefix=self.prefix, title=tops[0].title.title_text)
+        else:
+            subject = DIGEST_SUBJECT.substitute(prefix=self.prefix, count=len(tops))
+        body = MAIL_BODY.substitute(
+            salutation=salutation(user),
+            content=DIGEST_SEPARATOR.join(self.content(top) for top in tops),
+        )
+        return OutgoingMail(tops, user, address, self.from_address, subject, body, self.origin)
+
+
+def salutation(user: str) -> str:
+    if user.lower() in LIST_USERS:
+        return LIST_USERS[user.lower()]
+    return "Hallo {}".format(user)
+
+
+class OutgoingMail(object):
+    """a prepared mail to a single recipient about one or more TOPs"""
+
+    def __init__(self, tops, user, address, from_address, subject, body, origin=""):
+        self.tops = tops
+        self.user = user
+        self.address = address
+        self.from_address = from_address
+        self.subject = subject
+        self.body = body
+        self.origin = origin
+        self.data = None
 
-        return self.unknown
+    @property
+    def top(self):
+        return self.tops[0]
 
-    def send_mail(self, server) -> int:
+    @property
+    def title(self) -> str:
+        return ", ".join(top.title.title_text for top in self.tops)
 
-        for user, mail in zip(self.users, self.mails):
-            from_addr = self.args.from_address
+    @property
+    def message_id(self) -> str:
+        """the same mail always gets the same Message-ID, so it can't be spooled or received twice"""
+        digest = hashlib.sha256("\0".join((self.origin,) + Outbox.key(self)).encode("utf-8")).hexdigest()[:32]
+        return "<{}.protocoldude@{}>".format(digest, self.from_address.rpartition("@")[2] or "localhost")
 
-            msg = MIMEMultipart()
-            msg["From"] = from_addr
-            msg["To"] = mail
-            msg["Subject"] = self.args.mail_subject_prefix + " - " + self.title.title_text
+    def as_bytes(self) -> bytes:
+        """the message ready for sendmail(), rendered once"""
+        if self.data is None:
+            from email.mime.text import MIMEText
 
-            if user.lower() in LIST_USERS:
-                body = LIST_USERS[user.lower()] + ",\n\n"
+            msg = MIMEText(self.body, "plain", "utf-8")
+            msg["From"] = self.from_address
+            msg["To"] = self.address
+            msg["Subject"] = self.subject
+            msg["Message-ID"] = self.message_id
+            self.data = msg.as_bytes()
+        return self.data
+
+
+class Outbox(object):
+    """
+    Append-only journal of the mails of one protocol, stored next to it. Every
+    state change is synced to disk right away, so a rerun after a crash only
+    sends the mails that have not been sent yet.
+    """
+
+    QUEUED = "queued"
+    SENT = "sent"
+    SPOOLED = "spooled"
+    FAILED = "failed"
+    RESET = "reset"
+
+    def __init__(self, path):
+        self.path = path
+        self.states = {}
+        self.lock = threading.Lock()
+        if os.path.isfile(path):
+            with open(path, "r") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # line of an interrupted write
+                    self.apply(entry)
+
+    @staticmethod
+    def key(mail) -> tuple:
+        content = "\n".join([mail.from_address, mail.address, mail.subject, mail.body])
+        return (mail.title, mail.address, hashlib.sha256(content.encode("utf-8")).hexdigest())
+
+    def apply(self, entry):
+        if entry["state"] == Outbox.RESET:
+            self.states.clear()
+        else:
+            self.states[(entry["top"], entry["to"], entry["hash"])] = entry["state"]
+
+    def state(self, mail):
+        return self.states.get(Outbox.key(mail))
+
+    def record(self, mail, state, error=None):
+        self.record_many([mail], state, error)
+
+    def record_many(self, mails, state, error=None):
+        """records the same state for several mails with a single sync"""
+        entries = []
+        for mail in mails:
+            top, address, digest = Outbox.key(mail)
+            entries.append({"top": top, "to": address, "hash": digest, "state": state,
+                            "error": str(error) if error else None})
+        self.append(*entries)
+
+    def reset(self):
+        """forgets all earlier states, e.g. to send a protocol again"""
+        self.append({"state": Outbox.RESET})
+
+    def append(self, *entries):
+        if not entries:
+            return
+        now = datetime.datetime.now().isoformat(timespec="seconds")
+        with self.lock:
+            with open(self.path, "a") as file:
+                for entry in entries:
+                    entry["time"] = now
+                    file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+            for entry in entries:
+                self.apply(entry)
+
+    def dump(self, out=sys.stdout):
+        if not os.path.isfile(self.path):
+            print("Für dieses Protokoll wurden noch keine Mails verschickt.", file=out)
+            return
+        with open(self.path, "r") as file:
+            for line in file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                print("{}  {:<6}  {}  {}{}".format(
+                    entry["time"], entry["state"], entry.get("to", ""), entry.get("top", ""),
+                    "  ({})".format(entry["error"]) if entry.get("error") else ""), file=out)
+
+
+def outbox_path(path: str) -> str:
+    return sidecar_path(path, "outbox")
+
+
+def sidecar_path(path: str, suffix: str) -> str:
+    """hidden file next to the protocol, e.g. .yyyy-mm-dd.txt.outbox"""
+    directory, filename = os.path.split(path)
+    return os.path.join(directory, "." + filename + "." + suffix)
+
+
+class DeliveryResult(object):
+    def __init__(self, mail, attempts, error=None):
+        self.mail = mail
+        self.attempts = attempts
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+class SmtpConnector(object):
+    """
+    Opens SMTP connections for the delivery workers. The first connection
+    probes the MathPhys relay and falls back to the URZ relay with login,
+    the credentials are asked for once and reused for every connection.
+    """
+
+    def __init__(self, server=None, keep_alive=False):
+        # server ("host[:port]") skips the probing, e.g. for a local test server
+        self.relay = None
+        self.credentials = None
+        self.lock = threading.Lock()
+        # with keep_alive released connections are reused by later deliveries
+        self.keep_alive = keep_alive
+        self.idle = []
+        if server:
+            host, _, port = server.partition(":")
+            self.relay = (host, int(port or 25))
+
+    def __call__(self):
+        import smtplib
+        with self.lock:
+            if self.relay is None:
+                return self.probe()
+            idle, self.idle = self.idle, []
+        server = None
+        for connection in idle:
+            if server is not None:
+                self.release(connection)
+                continue
+            # the relay may have closed an idle connection in the meantime
+            try:
+                alive = connection.noop()[0] == 250
+            except (smtplib.SMTPException, OSError):
+                alive = False
+            if alive:
+                server = connection
             else:
-                body = "Hallo {},\n\n".format(user)
-            body += "Du sollst über irgendwas informiert werden. Im Sitzungsprotokoll steht dazu folgendes:\n\n{}\n\n\nViele Grüße, Dein SPAM-Skript.".format(self.__str__())
-
-            msg.attach(MIMEText(body, "plain"))
-            text = msg.as_string()
-            server.sendmail(from_addr, mail, text)
-            self.send +=1
-            print('Mail an "{}" zu {} gesendet.'.format(user, self.title.title_text))
-
-        return self.send
-
-
-def ldap_search(users: list, unknown: list) -> list:
-    """ searches for a list of users in our ldap """
-    server = ldap.initialize("ldaps://" + MATHPHYS_LDAP_ADDRESS)
-    users_old = users
-    users = [(user, "(uid={})".format(user)) for user in users]
-    users = [(
-        user, server.search_s(
-            MATHPHYS_LDAP_BASE_DN,
-            ldap.SCOPE_SUBTREE,
-            query
-        )
-    ) for user, query in users]
+                close_smtp(connection)
+        return server if server is not None else self.open()
+
+    def release(self, server):
+        """takes back a connection after a delivery, closes it unless keep_alive is set"""
+        if self.keep_alive:
+            with self.lock:
+                self.idle.append(server)
+        else:
+            close_smtp(server)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for server in idle:
+            close_smtp(server)
+
+    def probe(self):
+        import getpass
+        import smtplib
+        import socket
 
-    # Remove all users without query results
-    users = [user for user in users if user[1]]
-    non_found = [
-        old_user for old_user in users_old if old_user not in
-        [user[0] for user in users]
+        try:
+            server = smtplib.SMTP(MATHPHYS_SMTP_ADDRESS, 25, timeout=3)
+            self.relay = (MATHPHYS_SMTP_ADDRESS, 25)
+            return server
+        except socket.timeout as _:
+            self.relay = (URZ_SMTP_ADDRESS, 587)
+            while True:
+                username = input("Uni ID für den Mailversand: ")
+                prompt = "Passwort für {}: ".format(username)
+                self.credentials = (username, getpass.getpass(prompt=prompt))
+                try:
+                    return self.open()
+                except smtplib.SMTPAuthenticationError:
+                    print("\nDu hast die falschen Anmeldedaten eingegeben!")
+                    print("Bitte versuche es noch einmal:")
+
+    def open(self):
+        import smtplib
+
+        server = smtplib.SMTP(*self.relay, timeout=SMTP_TIMEOUT)
+        if self.credentials is not None:
+            server.starttls()
+            server.login(*self.credentials)
+        return server
+
+
+class TokenBucket(object):
+    """allows rate events per second on average and bursts of up to burst events, rate 0 means no limit"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = max(1.0, burst if burst is not None else 2 * rate)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def delay(self, now) -> float:
+        """seconds until the next token is available, 0 if there is one"""
+        if not self.rate:
+            return 0.0
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate:
+            self.tokens -= 1
+
+    def projected(self, count) -> float:
+        """seconds needed for count events starting with a full bucket"""
+        return max(0.0, (count - self.burst) / self.rate) if self.rate else 0.0
+
+
+def mail_domain(mail) -> str:
+    return mail.address.rpartition("@")[2].lower()
+
+
+def mail_priority(mail) -> int:
+    """mailing lists reach many people and go out before mails to individuals"""
+    return 0 if mail.address.partition("@")[0].lower() in LIST_USERS else 1
+
+
+class SendScheduler(object):
+    """
+    Hands the mails to the delivery workers in priority order (mailing lists
+    first, then in submission order) as fast as the token buckets of the
+    relay and of the recipient domains allow. Deferred mails wait for their
+    backoff in a separate heap while the other mails keep flowing.
+    """
+
+    def __init__(self, rate=SMTP_RATE, domain_rate=SMTP_DOMAIN_RATE):
+        self.relay = TokenBucket(rate)
+        self.domain_rate = domain_rate
+        self.buckets = {}
+        # ready mails per domain as heaps of (priority, index, attempt, mail)
+        self.ready = {}
+        # deferred mails as heap of (due, priority, index, attempt, mail)
+        self.waiting = []
+        self.counts = collections.Counter()
+        self.outstanding = 0
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def bucket(self, domain) -> TokenBucket:
+        if domain not in self.buckets:
+            self.buckets[domain] = TokenBucket(self.domain_rate)
+        return self.buckets[domain]
+
+    def put(self, index, mail, attempt=1, delay=0.0):
+        """adds a new mail, or a deferred one again after delay seconds"""
+        entry = (mail_priority(mail), index, attempt, mail)
+        with self.condition:
+            if attempt == 1:
+                self.outstanding += 1
+                self.counts[mail_domain(mail)] += 1
+            if delay:
+                heapq.heappush(self.waiting, (time.monotonic() + delay,) + entry)
+            else:
+                heapq.heappush(self.ready.setdefault(mail_domain(mail), []), entry)
+            self.condition.notify()
+
+    def get(self):
+        """blocks until a mail may be sent and returns (index, attempt, mail), None once all are done"""
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                while self.waiting and self.waiting[0][0] <= now:
+                    entry = heapq.heappop(self.waiting)[1:]
+                    heapq.heappush(self.ready.setdefault(mail_domain(entry[3]), []), entry)
+                if self.closed and not self.outstanding:
+                    return None
+                timeout = self.waiting[0][0] - now if self.waiting else None
+                relay = self.relay.delay(now)
+                best = None
+                for domain, entries in self.ready.items():
+                    if not entries:
+                        continue
+                    delay = max(relay, self.bucket(domain).delay(now))
+                    if delay:
+                        timeout = delay if timeout is None else min(timeout, delay)
+                    elif best is None or entries[0][:2] < self.ready[best][0][:2]:
+                        best = domain
+                if best is not None:
+                    self.relay.take()
+                    self.bucket(best).take()
+                    _, index, attempt, mail = heapq.heappop(self.ready[best])
+                    return index, attempt, mail
+                self.condition.wait(timeout)
+
+    def done(self):
+        """a mail was sent or finally failed"""
+        with self.condition:
+            self.outstanding -= 1
+            self.condition.notify_all()
+
+    def close(self):
+        """no more mails will be added, the workers stop once all are done"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def projected(self) -> float:
+        """lower bound in seconds for sending all mails within the rate limits"""
+        domains = [TokenBucket(self.domain_rate).projected(count) for count in self.counts.values()]
+        return max([self.relay.projected(sum(self.counts.values()))] + domains)
+
+
+class MailDelivery(object):
+    """
+    Sends prepared mails through a bounded pool of worker threads with one
+    SMTP connection each. A SendScheduler orders the mails and keeps to the
+    rate limits. Temporary failures (4xx answers, dropped connections) are
+    sent again with exponential backoff while the remaining mails go on, so
+    a single failure does not affect the others.
+    """
+
+    def __init__(self, connect, workers=SMTP_WORKERS, retries=SMTP_RETRIES, backoff=1.0, on_result=None,
+                 rate=SMTP_RATE, domain_rate=SMTP_DOMAIN_RATE, pipelining=False):
+        self.connect = connect
+        # send MAIL, RCPT and DATA at once if the relay supports PIPELINING
+        self.pipelining = pipelining
+        self.workers = max(1, workers)
+        self.retries = retries
+        self.backoff = backoff
+        self.on_result = on_result
+        self.scheduler = SendScheduler(rate, domain_rate)
+        self.submitted = 0
+        self.results = []
+        self.threads = []
+        self.deferred = 0
+        self.busy = 0.0
+        self.started = None
+        self.elapsed = 0.0
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.started = time.perf_counter()
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, mail):
+        self.scheduler.put(self.submitted, mail)
+        self.submitted += 1
+
+    def finish(self) -> list:
+        """waits for all submitted mails and returns the results in submission order"""
+        self.scheduler.close()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self.started is not None:
+            self.elapsed = time.perf_counter() - self.started
+        return [result for _, result in sorted(self.results, key=lambda item: item[0])]
+
+    def deliver(self, mails) -> list:
+        self.start()
+        for mail in mails:
+            self.submit(mail)
+        return self.finish()
+
+    def work(self):
+        server = None
+        while True:
+            item = self.scheduler.get()
+            if item is None:
+                break
+            index, attempt, mail = item
+            start = time.perf_counter()
+            try:
+                server, error, temporary = self.send(server, mail)
+            except Exception as exception:
+                # never lose a mail silently because of an unexpected error
+                server, error, temporary = None, exception, False
+            with self.lock:
+                self.busy += time.perf_counter() - start
+            if temporary and attempt < self.retries:
+                with self.lock:
+                    self.deferred += 1
+                self.scheduler.put(index, mail, attempt + 1, self.backoff * 2 ** (attempt - 1))
+                continue
+            result = DeliveryResult(mail, attempt, error)
+            try:
+                if self.on_result is not None:
+                    try:
+                        self.on_result(result)
+                    except Exception as exception:
+                        # e.g. the outbox could not be synced, the mail doesn't count as delivered
+                        result = DeliveryResult(mail, attempt, exception)
+                self.results.append((index, result))
+            finally:
+                # the other workers wait until every mail is done
+                self.scheduler.done()
+        if server is not None:
+            # a connector may keep the connection for the next run
+            getattr(self.connect, "release", close_smtp)(server)
+
+    def send(self, server, mail):
+        """
+        One delivery attempt, returns the connection to go on with, the error
+        and whether it is temporary and the mail should be sent again later.
+        """
+        import smtplib
+
+        text = mail.as_bytes()
+        try:
+            if server is None:
+                with PROFILER.span("connect", "smtp"):
+                    server = self.connect()
+            with PROFILER.span("sendmail", "smtp", bytes=len(text)):
+                if self.pipelining and server.has_extn("pipelining"):
+                    pipelined_sendmail(server, mail.from_address, mail.address, text)
+                else:
+                    server.sendmail(mail.from_address, mail.address, text)
+            return server, None, False
+        except smtplib.SMTPRecipientsRefused as exception:
+            codes = [code for code, _ in exception.recipients.values()]
+            return server, exception, all(400 <= code < 500 for code in codes)
+        except smtplib.SMTPResponseException as exception:
+            # 4xx answers are deferrals, 5xx answers won't change by trying again
+            if exception.smtp_code == 421:
+                # the relay closes the connection
+                close_smtp(server)
+                server = None
+            return server, exception, 400 <= exception.smtp_code < 500
+        except (smtplib.SMTPException, OSError) as exception:
+            if server is not None:
+                close_smtp(server)
+            return None, exception, True
+
+    def stats(self) -> str:
+        """projected time from the rate limits and the measured SMTP transactions versus the real time"""
+        sent = len(self.results) + self.deferred
+        transactions = self.busy / sent * len(self.results) / self.workers if sent else 0.0
+        projected = max(self.scheduler.projected(), transactions)
+        return "Mailversand: {} Mails in {:.1f} s (erwartet {:.1f} s), {} Zurückstellungen".format(
+            len(self.results), self.elapsed, projected, self.deferred)
+
+
+def pipelined_sendmail(server, from_address: str, address: str, data: bytes):
+    """
+    Like SMTP.sendmail() for a single recipient, but MAIL, RCPT and DATA are
+    sent in one packet (RFC 2920), which saves two round trips per mail.
+    Raises the same exceptions as sendmail().
+    """
+    import smtplib
+
+    server.ehlo_or_helo_if_needed()
+    server.send("mail FROM:{}\r\nrcpt TO:{}\r\ndata\r\n".format(
+        smtplib.quoteaddr(from_address), smtplib.quoteaddr(address)))
+    (mail_code, mail_message), (rcpt_code, rcpt_message), (data_code, data_message) = [
+        server.getreply() for _ in range(3)
     ]
-#    if len(users) < len(users_old):
-#        userstring = "\"" + "\", \"".join(non_found) + "\""
-#        print(f"\nThe following user could not be found in the LDAP: {userstring}")
-
-    return users
-
-def extract_mails(query: list) -> list:
-    """ extract mails from nonempty ldap queries """
-    mails = []
-    if query:
-        for user, result in query:
-            # dn = result[0]
-            if result:
-                attributes = result[0][1]
-                mails.append(attributes["mail"][0].decode("utf-8"))
-            # TODO: Implement select of alternatives
-    return mails
+    if data_code == 354:
+        if mail_code != 250 or rcpt_code not in (250, 251):
+            # the relay accepted DATA anyway, end the empty message, it is reset below
+            server.send(b".\r\n")
+            server.getreply()
+        else:
+            data = re.sub(br"(?:\r\n|\n|\r(?!\n))", b"\r\n", data)
+            data = re.sub(br"(?m)^\.", b"..", data)
+            if not data.endswith(b"\r\n"):
+                data += b"\r\n"
+            server.send(data + b".\r\n")
+            code, message = server.getreply()
+            if code != 250:
+                server.rset()
+                raise smtplib.SMTPDataError(code, message)
+            return
+    server.rset()
+    if mail_code != 250:
+        raise smtplib.SMTPSenderRefused(mail_code, mail_message, from_address)
+    if rcpt_code not in (250, 251):
+        raise smtplib.SMTPRecipientsRefused({address: (rcpt_code, rcpt_message)})
+    raise smtplib.SMTPDataError(data_code, data_message)
+
+
+def create_delivery(args, connect, on_result=None):
+    """a MailDelivery, or a SpoolDelivery with --spool"""
+    if args.spool:
+        return SpoolDelivery(Spool(args.spool), on_result)
+    return MailDelivery(
+        connect,
+        workers=args.smtp_workers,
+        on_result=on_result,
+        rate=args.smtp_rate,
+        domain_rate=args.smtp_domain_rate,
+    )
 
 
-class TOP_Title:
-    def __init__(self):
-        self.start = -1
-        self.end = -1
-        self.title_text = ""
+class Spool(object):
+    """
+    Local Maildir (or mbox file if the path ends with .mbox) that takes the
+    rendered mails instead of the relay, 'dude.py flush' sends them later.
+    Maildir file names are derived from the deterministic Message-ID, so a
+    mail spooled twice is stored only once.
+    """
 
-    def __init__(self, start, end, title_text):
-        self.start = start
-        self.end = end
-        self.title_text = title_text
+    def __init__(self, path):
+        self.path = path
+        self.mbox = path.endswith(".mbox")
+        self.box = None
+        self.message_ids = None
+        if not self.mbox:
+            for folder in ("tmp", "new", "cur"):
+                os.makedirs(os.path.join(path, folder), exist_ok=True)
+
+    def open_mbox(self):
+        if self.box is None:
+            import mailbox
+            self.box = mailbox.mbox(self.path)
+            self.box.lock()
+            self.message_ids = {self.box.get_message(key)["Message-ID"] for key in self.box.iterkeys()}
+        return self.box
+
+    def add(self, mail) -> bool:
+        """stores a mail, returns False if it is in the spool already"""
+        data = mail.as_bytes()
+        if self.mbox:
+            box = self.open_mbox()
+            if mail.message_id in self.message_ids:
+                return False
+            box.add(data)
+            self.message_ids.add(mail.message_id)
+            return True
+        name = mail.message_id.strip("<>").partition("@")[0]
+        target = os.path.join(self.path, "new", name)
+        if os.path.exists(target):
+            return False
+        # maildir delivery: write into tmp/, then move to new/
+        temp = os.path.join(self.path, "tmp", "{}.{}".format(name, os.getpid()))
+        with open(temp, "wb") as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+        os.rename(temp, target)
+        return True
 
-    def __str__(self):
-        return_str = ""
-        if self.title_text:
-            length = len(self.title_text)
-            return_str = "=" * length
-            return_str += "\n" + self.title_text + "\n"
-            return_str += "=" * length
-        return return_str
+    def messages(self):
+        """(key, data) of every spooled mail, oldest first"""
+        if self.mbox:
+            box = self.open_mbox()
+            for key in box.iterkeys():
+                yield key, box.get_bytes(key)
+            return
+        folder = os.path.join(self.path, "new")
+        names = sorted(os.listdir(folder), key=lambda name: os.stat(os.path.join(folder, name)).st_mtime)
+        for name in names:
+            with open(os.path.join(folder, name), "rb") as file:
+                yield name, file.read()
+
+    def remove(self, key):
+        if self.mbox:
+            self.open_mbox().remove(key)
+        else:
+            os.unlink(os.path.join(self.path, "new", key))
 
-    def list(self):
-        return str(self).split("\n")
+    def close(self):
+        if self.box is not None:
+            self.box.flush()
+            self.box.unlock()
+            self.box.close()
+            self.box = None
 
-    def rename(self, number):
-        if not re.search(r'(?i)TOP\s+\d+:', self.title_text):
-            self.title_text = "TOP {}: {}".format(number, self.title_text)
 
-def main():
-    # comment to disables error messages
-    # sys.tracebacklimit = 0
+class SpoolDelivery(object):
+    """writes the mails into a Spool, with the interface of MailDelivery"""
 
-    parser = argparse.ArgumentParser(description='''
-        Der Protocoldude macht automagisch aus deinem schnell zusammen geschriebenen inoffiziellen Protokoll eine ansehnliche Version.
-        Außerdem werden auf seltsame Weise Erinnerungs-Maills versandt.
-        Gib dazu folgenden Befehl im Zielordner mit vorhandenem Protokoll ein:
-            $ python3 protocoldude.py yyyy-mm-dd.txt
-        Damit der ganze Spaß funktioniert, solltest du aber trotzdem ein paar Formalia beachten. Dazu gehören:
-        - Überschriften erfüllen die Form:
-                ===
-                TOP: <name>
-                ===
-        - Zu benachrichtigende Personen werden erwähnt:
-                ${<intern>}
-                ${<external@some.com>}
-        ''',
-        epilog="Wer schlau ist, liest zwischen den Zeilen (oder im Code).")
-    parser.add_argument(
-        "infile",
-        metavar="<file>",
-        help="Pfad zum Protokoll. Die angegebene Datei muss folgende Benennung haben: 'yyyy-mm-dd.txt'",
-    )
-    parser.add_argument(
-        "--disable-svn",
-        help="Schaltet die SVN Interaktion ab.",
-        action="store_true",
-        dest="disable_svn",
-    )
-    parser.add_argument(
-        "--disable-tex",
-        help="Unterdruckt die Erstellung eines .tex Templates als offizielles Protokoll. So wird auch eine bereits existierende Datei nicht uberschrieben",
-        action="store_true",
-        dest="disable_tex",
-    )
-    parser.add_argument(
-        "--disable-path-checking",
-        help="Verhindert eine Überprüfung des angegebenen Dateinamens.",
-        action="store_true",
-        dest="disable_path_check",
-    )
-    parser.add_argument(
-        "--disable-mail",
-        help="Unterdrückt das Senden von Mails.",
-        action="store_true",
-        dest="disable_mail",
-    )
-    parser.add_argument(
-        "--enable-svn",
-        help="Schaltet die SVN Interaktion ein.",
-        action="store_false",
-        dest="disable_svn",
-    )
-    parser.add_argument(
-        "--enable-tex",
-        help="Erstelle eines .tex Templates als offizielles Protokoll.",
-        action="store_false",
-        dest="disable_tex",
-    )
-    parser.add_argument(
-        "--enable-path-checking",
-        help="Überprüfung des angegebenen Dateinamens",
-        action="store_false",
-        dest="disable_path_check",
-    )
-    parser.add_argument(
-        "--enable-mail",
-        help="Aktiviere das Senden von Mails.",
-        action="store_false",
-        dest="disable_mail",
-    )
-    parser.add_argument(
-        "--fromaddr",
-        help="Setze den Absender für die zu erstellenden Mails.",
-        action="store",
-        default="simo@mathphys.stura.uni-heidelberg.de",
-        dest="from_address",
-    )
-    parser.add_argument(
-        "--mail-subject",
-        help="Ändere den Betreff für die zu erstellenden Mails.",
-        action="store",
-        default="Gemeinsame Sitzung",
-        dest="mail_subject_prefix",
-    )
-    parser.add_argument(
-        "-v",
-        "--version",
-        help="Gib die Version an ohne das Programm auszuführen.",
-        action="version",
-        version=__version__,
-    )
+    def __init__(self, spool, on_result=None):
+        self.spool = spool
+        self.on_result = on_result
+        self.results = []
+        self.duplicates = 0
 
+    def start(self):
+        pass
 
-    if len(sys.argv)==1: # print help message if no arguments were given
-        parser.print_help(sys.stderr)
-        sys.exit(1)
+    def submit(self, mail):
+        try:
+            with PROFILER.span("spool", "io"):
+                if not self.spool.add(mail):
+                    self.duplicates += 1
+            result = DeliveryResult(mail, 1)
+        except OSError as exception:
+            result = DeliveryResult(mail, 1, exception)
+        self.results.append(result)
+        if self.on_result is not None:
+            self.on_result(result)
+
+    def finish(self) -> list:
+        self.spool.close()
+        return self.results
+
+    def deliver(self, mails) -> list:
+        for mail in mails:
+            self.submit(mail)
+        return self.finish()
+
+    def stats(self) -> str:
+        return "{} Mails in den Spool {} geschrieben ({} waren schon darin). Verschicken mit: dude.py flush {}".format(
+            len(self.results), self.spool.path, self.duplicates, self.spool.path)
+
+
+class SpooledMail(object):
+    """a mail read back from the spool by 'dude.py flush'"""
+
+    def __init__(self, key, data):
+        from email.parser import BytesHeaderParser
+        from email.utils import parseaddr
+        headers = BytesHeaderParser().parsebytes(data)
+        self.key = key
+        self.data = data
+        self.from_address = parseaddr(headers["From"] or "")[1]
+        self.address = parseaddr(headers["To"] or "")[1]
+        self.user = self.address
+        self.subject = str(headers["Subject"] or "")
+        self.title = self.subject
+        self.tops = []
 
-    if os.path.isfile('config.ini'):
-        config = configparser.ConfigParser()
-        config.read('config.ini')
-        defaults = dict(config['default'])
-        for key in defaults:
-            if defaults[key]=='True':
-                defaults.update({key: True})
-            elif defaults[key]=='False':
-                defaults.update({key: False})
-        parser.set_defaults(**defaults)
+    def as_bytes(self) -> bytes:
+        return self.data
 
-    args = parser.parse_args()
 
-    protocol = Protocol(args)
-    if protocol.check_dude():
-        print("Das Protokoll wurde bereits gedudet.")
-        if input("Bist du sicher, dass du Leuten nochmal nervige SPAM Mails schicken willst? [j/N]") != "j":
-            return
-    if not args.disable_path_check:
-        protocol.check_path()
-    protocol.get_tops()
-    protocol.get_users()
-    protocol.rename_title()
+def close_smtp(server):
+    import smtplib
+
+    try:
+        server.quit()
+    except (smtplib.SMTPException, OSError):
+        server.close()
+
+
+def resolve_user(user: str, resolver):
+    """returns (name, mail) for a mentioned user or None if nothing matches"""
+    mail = resolver.lookup(user)
+    if mail:
+        return user, mail
+    if user.lower() in LIST_USERS:
+        return user, user + "@" + LIST_DOMAIN
+    if re.match(r"[^@]+@[^@]+\.[^@]+", user):
+        if ' ' in user:
+            name = " ".join([u for u in user.split() if not '@' in u])
+            mail = [u for u in user.split() if '@' in u][0]
+            return name, mail
+        # user is valid mail address
+        return user.split('@')[0], user
+    return None
+
+
+def is_list(member: str) -> bool:
+    """checks whether a mention or member is one of the LIST_USERS lists, by name or by address"""
+    name, _, domain = member.lower().partition("@")
+    return name in LIST_USERS and domain in ("", LIST_DOMAIN)
+
+
+def contains_list(members, name: str) -> bool:
+    return name in members or name + "@" + LIST_DOMAIN in members
+
+
+def read_members(path) -> dict:
+    """
+    reads the local membership file, one line per mailing list in section [listen]:
+        fsr = alice, bob, carol@example.org
+    """
+    config = configparser.ConfigParser()
+    config.read(path, encoding="utf-8")
+    if not config.has_section("listen"):
+        return {}
+    return {
+        name.lower(): frozenset(member.strip().lower() for member in re.split(r"[,\s]+", value) if member.strip())
+        for name, value in config.items("listen")
+    }
+
+
+class SuggestionIndex(object):
+    """
+    Trigram index over known user and list names. It is built once per run
+    and proposes the most similar names for an unknown user.
+    """
+
+    def __init__(self, names):
+        self.names = sorted({name.lower() for name in names})
+        self.trigrams = collections.defaultdict(list)
+        for k, name in enumerate(self.names):
+            for trigram in trigrams(name):
+                self.trigrams[trigram].append(k)
+
+    def suggest(self, user: str, limit=3) -> list:
+        """returns up to limit (name, similarity) pairs, best first"""
+        import difflib
+
+        user = user.lower()
+        shared = collections.Counter()
+        for trigram in trigrams(user):
+            shared.update(self.trigrams.get(trigram, ()))
+        # only names sharing the most trigrams are compared in detail
+        scored = [
+            (self.names[k], difflib.SequenceMatcher(None, user, self.names[k]).ratio())
+            for k, _ in shared.most_common(limit * 5)
+        ]
+        scored.sort(key=lambda item: -item[1])
+        return scored[:limit]
+
+
+def trigrams(text: str) -> set:
+    padded = "  " + text + " "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class LdapResolver(object):
+    """
+    Resolves uids to mail addresses over a single LDAP connection that stays
+    open for the whole run. Lookups are combined into one OR filter per chunk.
+    """
+
+    def __init__(self, connection=None, chunk_size=LDAP_CHUNK_SIZE, cache=None, offline=False, members_file=None):
+        # connection may be any object providing search_s(), e.g. a fake backend
+        self.connection = connection
+        # only connections opened here are opened again after the server dropped them
+        self.reconnect = connection is None
+        self.chunk_size = chunk_size
+        self.cache = cache
+        self.offline = offline
+        self.mails = {}
+        self.queries = 0
+        # mailing list -> frozenset of member uids, addresses and lists, see load_members()
+        self.members_file = members_file
+        self.members = None
+
+    def connect(self):
+        if self.connection is None:
+            import ldap
+            self.connection = ldap.initialize("ldaps://" + MATHPHYS_LDAP_ADDRESS)
+        return self.connection
+
+    def resolve(self, users: list) -> dict:
+        """looks up all given users that have not been resolved before"""
+        pending = sorted({user.lower() for user in users if is_uid(user)} - set(self.mails))
+        if self.cache is not None:
+            cached = self.cache.get_many(pending)
+            self.mails.update(cached)
+            pending = [uid for uid in pending if uid not in cached]
+        if self.offline:
+            # nothing is cached for users that could not be looked up
+            self.mails.update((uid, None) for uid in pending)
+            pending = []
+        for i in range(0, len(pending), self.chunk_size):
+            chunk = pending[i:i + self.chunk_size]
+            query = "(|{})".format("".join("(uid={})".format(ldap_escape(uid)) for uid in chunk))
+            with PROFILER.span("search_s", "ldap", uids=len(chunk)) as span:
+                results = self.search(query)
+                span["results"] = len(results)
+            self.queries += 1
+            self.mails.update((uid, None) for uid in chunk)
+            for dn, attributes in results:
+                if not attributes.get("mail"):
+                    continue
+                mail = attributes["mail"][0].decode("utf-8")
+                for uid in attributes.get("uid", []):
+                    self.mails[uid.decode("utf-8").lower()] = mail
+            if self.cache is not None:
+                self.cache.put_many((uid, self.mails[uid]) for uid in chunk)
+        return {user: self.mails.get(user.lower()) for user in users}
+
+    def search(self, query: str, base=MATHPHYS_LDAP_BASE_DN, attributes=("uid", "mail")) -> list:
+        try:
+            return self.connect().search_s(base, LDAP_SCOPE_SUBTREE, query, list(attributes))
+        except Exception as exception:
+            # the server closes idle connections of long running processes, connect once more
+            if type(exception).__name__ != "SERVER_DOWN" or not self.reconnect:
+                raise
+            self.connection = None
+            return self.connect().search_s(base, LDAP_SCOPE_SUBTREE, query, list(attributes))
+
+    def load_members(self, lists: list):
+        """
+        Loads the members of the given mailing lists and of the lists nested in
+        them that are not known yet, from the membership file, the cache or
+        with one LDAP query per nesting level.
+        """
+        if self.members is None:
+            self.members = {}
+            if self.members_file and os.path.isfile(self.members_file):
+                self.members.update(read_members(self.members_file))
+        pending = sorted({name.lower().partition("@")[0] for name in lists if is_list(name)} - set(self.members))
+        while pending:
+            requested = pending
+            if self.cache is not None:
+                self.members.update(self.cache.get_members(pending))
+                pending = [name for name in pending if name not in self.members]
+            if pending and not self.offline:
+                query = "(|{})".format("".join("(cn={})".format(ldap_escape(name)) for name in pending))
+                try:
+                    with PROFILER.span("search_s", "ldap", lists=len(pending)) as span:
+                        results = self.search(query, MATHPHYS_LDAP_GROUP_DN, ("cn",) + LDAP_MEMBER_ATTRIBUTES)
+                        span["results"] = len(results)
+                except Exception as exception:
+                    # e.g. NO_SUCH_OBJECT or INSUFFICIENT_ACCESS, the mails are sent as if nothing was known
+                    print("Die Mitglieder der Mailing-Listen {} konnten nicht aus dem LDAP gelesen werden ({}),"
+                          " sie werden als unbekannt behandelt.".format(", ".join(pending), type(exception).__name__))
+                    results = None
+                self.queries += 1
+                found = {}
+                for dn, attributes in results or []:
+                    members = set()
+                    for attribute in LDAP_MEMBER_ATTRIBUTES:
+                        for value in attributes.get(attribute, []):
+                            # member holds DNs like uid=alice,ou=People,..., the others uids or addresses
+                            members.add(re.sub(r"(?i)^(?:uid|cn)=([^,]+),.*$", r"\1", value.decode("utf-8")).lower())
+                    for cn in attributes.get("cn", []):
+                        found.setdefault(cn.decode("utf-8").lower(), set()).update(members)
+                # lists without a group entry have no known members, that is cached as well, a failed
+                # lookup only for a day so neither the warning nor the query repeat on every run
+                self.members.update((name, frozenset(found.get(name, ()))) for name in pending)
+                if self.cache is not None:
+                    self.cache.put_members(((name, self.members[name]) for name in pending), failed=results is None)
+            # lists without any source simply have no known members
+            self.members.update((name, frozenset()) for name in pending if name not in self.members)
+            nested = {member.partition("@")[0] for name in requested for member in self.members[name] if is_list(member)}
+            pending = sorted(nested - set(self.members))
+
+    def expand(self, name: str) -> set:
+        """all members of a mailing list, including the members of nested lists"""
+        members = set()
+        stack = [name.lower().partition("@")[0]]
+        while stack:
+            current = stack.pop()
+            for member in self.members.get(current, ()):
+                if member in members:
+                    continue
+                members.add(member)
+                if is_list(member):
+                    stack.append(member.partition("@")[0])
+        return members
+
+    def covered(self, recipients: list) -> list:
+        """the (user, mail) recipients that are also reached through one of the mailing lists among them"""
+        lists = [address.lower().partition("@")[0] for _, address in recipients if is_list(address)]
+        if not lists:
+            return []
+        self.load_members(lists)
+        expanded = {name: self.expand(name) for name in lists}
+        covered = []
+        for user, address in recipients:
+            if is_list(address):
+                name = address.lower().partition("@")[0]
+                # lists containing each other don't cover each other, one of them has to stay
+                reached = any(
+                    contains_list(expanded[other], name) and not contains_list(expanded[name], other)
+                    for other in lists if other != name
+                )
+            else:
+                # the uid only counts if the user was resolved through the LDAP, never a display name
+                keys = {address.lower()}
+                if self.mails.get(user.lower()) == address:
+                    keys.add(user.lower())
+                reached = any(keys & members for members in expanded.values())
+            if reached:
+                covered.append((user, address))
+        return covered
+
+    def forget_unknown(self):
+        """
+        forgets the uids without mail address and the list members, e.g. before
+        the next protocol of 'dude.py watch'
+        """
+        self.mails = {uid: mail for uid, mail in self.mails.items() if mail}
+        self.members = None
+
+    def lookup(self, user: str):
+        """returns the mail address of a single user or None"""
+        if user.lower() not in self.mails:
+            self.resolve([user])
+        return self.mails.get(user.lower())
+
+    def known_uids(self) -> list:
+        """all uids with a known mail address, from this run and the cache"""
+        uids = [uid for uid, mail in self.mails.items() if mail]
+        if self.cache is not None:
+            uids += self.cache.uids()
+        return uids
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.unbind_s()
+            self.connection = None
+        if self.cache is not None:
+            self.cache.close()
+
+    def stats(self) -> str:
+        stats = "LDAP-Anfragen: {}".format(self.queries)
+        if self.cache is not None:
+            stats += ", Cache-Treffer: {}, Cache-Fehlschläge: {}".format(self.cache.hits, self.cache.misses)
+        return stats
+
+
+class RecipientCache(object):
+    """
+    Persistent uid -> mail cache in a SQLite file. Every entry expires after
+    its own TTL, uids unknown to the LDAP are cached as well (negative caching).
+    """
+
+    def __init__(self, path=None, ttl=CACHE_TTL, negative_ttl=CACHE_NEGATIVE_TTL, refresh=False):
+        if path is None:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            path = os.path.join(CACHE_DIR, "recipients.sqlite")
+        self.ttl = ttl * 86400
+        self.negative_ttl = negative_ttl * 86400
+        # with refresh set, existing entries are ignored but overwritten
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        import sqlite3
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS recipients (uid TEXT PRIMARY KEY, mail TEXT, expires REAL NOT NULL)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS members (list TEXT PRIMARY KEY, members TEXT, expires REAL NOT NULL)"
+        )
+
+    def get_many(self, uids: list) -> dict:
+        """returns the cached, not yet expired entries of the given uids"""
+        found = {}
+        if not self.refresh:
+            with self.lock:
+                for uid in uids:
+                    row = self.db.execute(
+                        "SELECT mail FROM recipients WHERE uid = ? AND expires > ?", (uid, time.time())
+                    ).fetchone()
+                    if row is not None:
+                        found[uid] = row[0]
+        self.hits += len(found)
+        self.misses += len(uids) - len(found)
+        return found
+
+    def put_many(self, entries):
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO recipients (uid, mail, expires) VALUES (?, ?, ?)",
+                [(uid, mail, now + (self.ttl if mail else self.negative_ttl)) for uid, mail in entries],
+            )
+
+    def get_members(self, lists: list) -> dict:
+        """returns the cached, not yet expired members of the given mailing lists"""
+        found = {}
+        if not self.refresh:
+            with self.lock:
+                for name in lists:
+                    row = self.db.execute(
+                        "SELECT members FROM members WHERE list = ? AND expires > ?", (name, time.time())
+                    ).fetchone()
+                    if row is not None:
+                        found[name] = frozenset(row[0].split())
+        return found
+
+    def put_members(self, entries, failed=False):
+        """lists whose lookup failed are kept as empty for the shorter negative lifetime"""
+        expires = time.time() + (self.negative_ttl if failed else self.ttl)
+        with self.lock, self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO members (list, members, expires) VALUES (?, ?, ?)",
+                [(name, " ".join(sorted(members)), expires) for name, members in entries],
+            )
+
+    def uids(self) -> list:
+        """all uids with a known mail address"""
+        with self.lock:
+            return [row[0] for row in self.db.execute("SELECT uid FROM recipients WHERE mail IS NOT NULL")]
+
+    def close(self):
+        self.db.close()
+
+
+class ProtocolIndex(object):
+    """
+    Full-text index over the TOPs of a protocol archive in a SQLite FTS5 table.
+    Files are only parsed again if their mtime, size and content hash changed.
+    """
+
+    # bm25 weights of the columns path, date, number, title, recipients, body
+    WEIGHTS = (0.0, 0.0, 0.0, 10.0, 5.0, 1.0)
+
+    def __init__(self, path=None):
+        if path is None:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            path = os.path.join(CACHE_DIR, "index.sqlite")
+        import sqlite3
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime REAL, size INTEGER, sha256 TEXT)"
+        )
+        self.db.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS tops USING fts5("
+            "path UNINDEXED, date UNINDEXED, number UNINDEXED, title, recipients, body, prefix='2 3')"
+        )
+
+    def update(self, paths: list) -> tuple:
+        """indexes new and changed protocols, drops deleted ones, returns (indexed, unchanged, removed)"""
+        indexed = unchanged = 0
+        known = {row[0]: row[1:] for row in self.db.execute("SELECT path, mtime, size, sha256 FROM files")}
+        with self.db:
+            for path in paths:
+                path = os.path.abspath(path)
+                stat = os.stat(path)
+                entry = known.get(path)
+                if entry is not None and entry[:2] == (stat.st_mtime, stat.st_size):
+                    unchanged += 1
+                    continue
+                with open(path, "rb") as file:
+                    content = file.read()
+                digest = hashlib.sha256(content).hexdigest()
+                if entry is None or entry[2] != digest:
+                    self.db.execute("DELETE FROM tops WHERE path = ?", (path,))
+                    self.db.executemany(
+                        "INSERT INTO tops (path, date, number, title, recipients, body) VALUES (?, ?, ?, ?, ?, ?)",
+                        self.rows(path, content),
+                    )
+                    indexed += 1
+                else:
+                    unchanged += 1
+                self.db.execute(
+                    "INSERT OR REPLACE INTO files (path, mtime, size, sha256) VALUES (?, ?, ?, ?)",
+                    (path, stat.st_mtime, stat.st_size, digest),
+                )
+            removed = [path for path in known if not os.path.isfile(path)]
+            for path in removed:
+                self.db.execute("DELETE FROM tops WHERE path = ?", (path,))
+                self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+        return indexed, unchanged, len(removed)
+
+    @staticmethod
+    def rows(path: str, content: bytes):
+        """one row per TOP, found with the same parser as get_tops()"""
+        lines = ProtocolBuffer(content)
+        document = parse_protocol(lines)
+        date = os.path.basename(path)[:10]
+        for top in document.tops:
+            title = TOP_Title(top.start, top.start + 3, lines[top.start + 1]).plain_text()
+            body = "\n".join(MENTION_RE.sub(r"\1", line) for line in lines[top.start + 3:top.end])
+            recipients = " ".join(document.mentions.texts(top.number - 1))
+            yield path, date, top.number, title, recipients, body
+
+    def search(self, query: str, since=None, limit=20, paths=None) -> list:
+        """
+        ranked (date, number, title, snippet, path) tuples, best match first;
+        the index is shared by all archives, with paths only these protocols are searched
+        """
+        import sqlite3
+        scope = ""
+        if paths is not None:
+            self.db.execute("CREATE TEMP TABLE IF NOT EXISTS scope (path TEXT PRIMARY KEY)")
+            self.db.execute("DELETE FROM temp.scope")
+            self.db.executemany("INSERT OR IGNORE INTO temp.scope (path) VALUES (?)",
+                                ((os.path.abspath(path),) for path in paths))
+            scope = "AND path IN (SELECT path FROM temp.scope) "
+        sql = (
+            "SELECT date, number, title, snippet(tops, 5, '[', ']', '…', 12), path FROM tops "
+            "WHERE tops MATCH ? AND date >= ? {}ORDER BY bm25(tops, {}) LIMIT ?"
+        ).format(scope, ", ".join(str(weight) for weight in self.WEIGHTS))
+        if not fts_query(query):
+            return []
+        try:
+            return self.db.execute(sql, (fts_query(query), since or "", limit)).fetchall()
+        except sqlite3.OperationalError:
+            # not a valid FTS5 query, search for the words literally
+            return self.db.execute(sql, (fts_query(query, literal=True), since or "", limit)).fetchall()
+
+    def close(self):
+        self.db.close()
+
+
+def fts_query(query: str, literal=False) -> str:
+    """translates ${user} mentions in a query into searches in the recipients column"""
+    users = MENTION_RE.findall(query)
+    words = MENTION_RE.sub(" ", query)
+    if literal:
+        words = " ".join('"' + word.replace('"', '""') + '"' for word in words.split())
+    terms = ['recipients : "' + user.replace('"', '""') + '"' for user in users]
+    if words.strip():
+        terms.append("(" + words.strip() + ")" if users else words.strip())
+    return " AND ".join(terms)
+
+
+class ArchiveStats(object):
+    """
+    Header fields and counts of every protocol in the archive as typed arrays
+    in one binary file. Only new and changed protocols are parsed again, the
+    reports run over the arrays without reading the archive.
+    """
+
+    MAGIC = b"PDSTATS1"
+    # the protocol columns have one row per protocol sorted by date, the list
+    # columns one row per protocol and mentioned mailing list sorted by protocol
+    COLUMNS = (
+        ("date", "i"), ("mtime", "q"), ("size", "q"), ("duration", "i"), ("simo", "i"), ("writer", "i"),
+        ("tops", "i"), ("list_row", "i"), ("list_name", "i"), ("list_tops", "i"),
+    )
+
+    def __init__(self, path=None):
+        if path is None:
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            path = os.path.join(CACHE_DIR, "stats.bin")
+        self.path = path
+        self.paths = []
+        # names of moderators, writers and lists, the columns hold their index
+        self.strings = []
+        self.string_ids = {}
+        self.columns = {name: array.array(code) for name, code in self.COLUMNS}
+        if os.path.isfile(path):
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "rb") as file:
+                if file.read(len(self.MAGIC)) != self.MAGIC:
+                    return
+                header = json.loads(file.read(int.from_bytes(file.read(4), "little")).decode("utf-8"))
+                if header["byteorder"] != sys.byteorder:
+                    return
+                columns = {}
+                for name, code in self.COLUMNS:
+                    columns[name] = array.array(code)
+                    columns[name].fromfile(file, header["lengths"][name])
+        except (EOFError, KeyError, ValueError):
+            # an unknown or broken file is built again by the next update()
+            return
+        self.paths = header["paths"]
+        self.strings = header["strings"]
+        self.string_ids = {string: k for k, string in enumerate(self.strings)}
+        self.columns = columns
+
+    def save(self):
+        import tempfile
+        header = json.dumps({
+            "byteorder": sys.byteorder,
+            "paths": self.paths,
+            "strings": self.strings,
+            "lengths": {name: len(column) for name, column in self.columns.items()},
+        }, ensure_ascii=False).encode("utf-8")
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                file.write(self.MAGIC + len(header).to_bytes(4, "little") + header)
+                for name, _ in self.COLUMNS:
+                    self.columns[name].tofile(file)
+            os.replace(temp, self.path)
+        except BaseException:
+            os.unlink(temp)
+            raise
+
+    def update(self, paths: list) -> tuple:
+        """parses new and changed protocols, drops deleted ones, returns (parsed, unchanged, removed)"""
+        known = {path: k for k, path in enumerate(self.paths)}
+        rows = []
+        parsed = 0
+        for path in paths:
+            path = os.path.abspath(path)
+            try:
+                date = datetime.date.fromisoformat(os.path.basename(path)[:10])
+            except ValueError:
+                print("{} wird übersprungen, {} ist kein gültiges Datum.".format(path, os.path.basename(path)[:10]))
+                continue
+            stat = os.stat(path)
+            k = known.pop(path, None)
+            if k is not None and (self.columns["mtime"][k], self.columns["size"][k]) == (stat.st_mtime_ns,
+                                                                                          stat.st_size):
+                rows.append(self.row(k))
+            else:
+                rows.append(self.parse(path, stat, date))
+                parsed += 1
+        if parsed or known:
+            self.rebuild(rows)
+            self.save()
+        return parsed, len(rows) - parsed, len(known)
+
+    def row(self, k) -> tuple:
+        """(path, protocol values, [(list, TOPs)]) of an existing row"""
+        columns = self.columns
+        start, end = self.list_range(range(k, k + 1))
+        return (
+            self.paths[k],
+            [columns[name][k] for name in ("date", "mtime", "size", "duration", "simo", "writer", "tops")],
+            list(zip(columns["list_name"][start:end], columns["list_tops"][start:end])),
+        )
+
+    def parse(self, path, stat, date) -> tuple:
+        lines = ProtocolBuffer.from_file(path)
+        document = parse_protocol(lines)
+        duration = session_minutes(document.header.get("Beginn"), document.header.get("Ende"))
+        mentions = document.mentions
+        # every list counts once per TOP
+        lists = collections.Counter(name for _, name in {
+            (mentions.top[k], mentions.text[k].lower().partition("@")[0])
+            for k in range(len(mentions)) if mentions.top[k] >= 0 and is_list(mentions.text[k])
+        })
+        values = [
+            date.toordinal(), stat.st_mtime_ns, stat.st_size, -1 if duration is None else duration,
+            self.intern(person(document.header.get("Simo"))), self.intern(person(document.header.get("Protokoll"))),
+            len(document.tops),
+        ]
+        return path, values, sorted((self.intern(name), count) for name, count in lists.items())
+
+    def intern(self, string) -> int:
+        if not string:
+            return -1
+        if string not in self.string_ids:
+            self.string_ids[string] = len(self.strings)
+            self.strings.append(string)
+        return self.string_ids[string]
+
+    def rebuild(self, rows):
+        rows.sort(key=lambda row: (row[1][0], row[0]))
+        self.paths = [path for path, _, _ in rows]
+        columns = self.columns = {name: array.array(code) for name, code in self.COLUMNS}
+        for k, (_, values, lists) in enumerate(rows):
+            for (name, _), value in zip(self.COLUMNS, values):
+                columns[name].append(value)
+            for name, count in lists:
+                columns["list_row"].append(k)
+                columns["list_name"].append(name)
+                columns["list_tops"].append(count)
+
+    def select(self, since=None, until=None) -> range:
+        """the rows of the protocols between two dates, found by bisection of the date column"""
+        dates = self.columns["date"]
+        start = bisect.bisect_left(dates, since.toordinal()) if since else 0
+        end = bisect.bisect_right(dates, until.toordinal()) if until else len(dates)
+        return range(start, max(start, end))
+
+    def list_range(self, rows: range) -> tuple:
+        column = self.columns["list_row"]
+        return bisect.bisect_left(column, rows.start), bisect.bisect_left(column, rows.stop)
+
+    def sessions(self, rows: range, by="semester") -> list:
+        """(period, sessions, average minutes or None, TOPs) per semester or year, oldest first"""
+        dates, durations, tops = self.columns["date"], self.columns["duration"], self.columns["tops"]
+        groups = {}
+        for k in rows:
+            # sessions, sessions with a duration, minutes, TOPs
+            group = groups.setdefault(period(dates[k], by), [0, 0, 0, 0])
+            group[0] += 1
+            if durations[k] >= 0:
+                group[1] += 1
+                group[2] += durations[k]
+            group[3] += tops[k]
+        return [(name, count, minutes / timed if timed else None, top_count)
+                for name, (count, timed, minutes, top_count) in groups.items()]
+
+    def ranking(self, column: str, rows: range, limit=5) -> list:
+        """the most frequent names of the simo or writer column as (name, sessions)"""
+        values = self.columns[column][rows.start:rows.stop]
+        counts = collections.Counter(values)
+        counts.pop(-1, None)
+        return [(self.strings[k], count) for k, count in counts.most_common(limit)]
+
+    def lists(self, rows: range, by="semester", limit=5) -> list:
+        """(period, [(list, TOPs)]) with the most mentioned mailing lists per semester or year"""
+        start, end = self.list_range(rows)
+        dates = self.columns["date"]
+        groups = {}
+        for row, name, count in zip(*(self.columns[column][start:end]
+                                      for column in ("list_row", "list_name", "list_tops"))):
+            groups.setdefault(period(dates[row], by), collections.Counter())[name] += count
+        return [(name, [(self.strings[k], count) for k, count in counts.most_common(limit)])
+                for name, counts in groups.items()]
+
+
+def session_minutes(begin, end):
+    """length of a session from its 'Beginn:' and 'Ende:' times, None if one of them is missing"""
+    times = [re.search(r"(\d{1,2})[:.](\d{2})", value or "") for value in (begin, end)]
+    if not all(times):
+        return None
+    begin, end = (int(match.group(1)) * 60 + int(match.group(2)) for match in times)
+    # sessions may last past midnight
+    return (end - begin) % (24 * 60)
+
+
+def person(value) -> str:
+    """the name in a header field like 'Protokoll: ChrisB ${chrisb}', the mention if there is nothing else"""
+    if not value:
+        return ""
+    return " ".join(MENTION_RE.sub(" ", value).split()) or " ".join(MENTION_RE.findall(value))
+
+
+def period(ordinal: int, by="semester") -> str:
+    """the semester (summer semester from April to September) or the year of a date"""
+    date = datetime.date.fromordinal(ordinal)
+    if by == "year":
+        return str(date.year)
+    if 4 <= date.month <= 9:
+        return "SoSe {}".format(date.year)
+    year = date.year if date.month >= 10 else date.year - 1
+    return "WiSe {}/{:02d}".format(year, (year + 1) % 100)
+
+
+def export_records(paths, resolver, since=None):
+    """
+    Yields one record per TOP of the given protocols. The protocols are read
+    one after the other, so memory use doesn't grow with the archive.
+    """
+    for path in paths:
+        date = os.path.basename(path)[:10]
+        if since is not None and date < since.isoformat():
+            continue
+        lines = ProtocolBuffer.from_file(path)
+        document = parse_protocol(lines)
+        tops = [TOP(span.number, span.start, span.end, lines, document.mentions) for span in document.tops]
+        for top in tops:
+            top.rename()
+            top.get_user()
+        # one lookup for all users of the protocol
+        resolver.resolve([user for top in tops for user in top.users])
+        for top in tops:
+            recipients = []
+            unknown = []
+            for user in top.users:
+                result = resolve_user(user, resolver)
+                if result:
+                    recipients.append({"name": result[0], "mail": result[1]})
+                else:
+                    unknown.append(user)
+            yield {
+                "date": date,
+                "file": os.path.basename(path),
+                "number": top.number,
+                "title": top.title.title_text,
+                "body": "\n".join(lines[top.title.end:top.end]).strip("\n"),
+                "recipients": recipients,
+                "unknown": unknown,
+            }
+
+
+def is_url(path: str) -> bool:
+    """only http(s) URLs are downloaded, local paths may contain 'http' as well"""
+    return re.match(r"^https?://", path, re.IGNORECASE) is not None
+
+
+class Downloader(object):
+    """
+    Downloads protocols from pads and notes into an on-disk cache. The ETag
+    and Last-Modified header of every download are kept, so downloading an
+    unchanged protocol again costs a single 304 response.
+    """
+
+    def __init__(self, directory=DOWNLOAD_DIR, timeout=DOWNLOAD_TIMEOUT, retries=DOWNLOAD_RETRIES, backoff=1.0):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.downloads = 0
+        self.not_modified = 0
+
+    def paths(self, url: str) -> tuple:
+        """cached body and validators of an URL"""
+        key = os.path.join(self.directory, hashlib.sha256(url.encode("utf-8")).hexdigest())
+        return key + ".txt", key + ".json"
+
+    def fetch(self, url: str) -> str:
+        """downloads the URL if it changed and returns the path of the cached file"""
+        import urllib.error
+        import urllib.request
+        body, meta = self.paths(url)
+        headers = {}
+        if os.path.isfile(body) and os.path.isfile(meta):
+            with open(meta, "r") as file:
+                validators = json.load(file)
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+
+        error = None
+        for attempt in range(1, self.retries + 1):
+            try:
+                with PROFILER.span("download", "io", url=url, attempt=attempt):
+                    with urllib.request.urlopen(urllib.request.Request(url, headers=headers),
+                                                timeout=self.timeout) as response:
+                        self.store(response, body, meta)
+                self.downloads += 1
+                return body
+            except urllib.error.HTTPError as exception:
+                if exception.code == 304:
+                    self.not_modified += 1
+                    print("Das Protokoll {} hat sich seit dem letzten Download nicht geändert.".format(url))
+                    return body
+                error = exception
+                if exception.code < 500:
+                    # client errors don't go away by asking again
+                    break
+            except OSError as exception:
+                # URLError, refused connections and timeouts
+                error = exception
+            if attempt < self.retries:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+
+        if os.path.isfile(body):
+            print("Download von {} fehlgeschlagen ({}), die zwischengespeicherte Version wird verwendet.".format(
+                url, error))
+            return body
+        raise ConnectionError("Das Protokoll {} konnte nicht heruntergeladen werden: {}".format(url, error))
+
+    def store(self, response, body: str, meta: str):
+        """streams the response into the cache, other charsets are converted to UTF-8 on the way"""
+        import codecs
+        import tempfile
+        charset = response.headers.get_content_charset() or "utf-8"
+        try:
+            decoder = None if codecs.lookup(charset).name == "utf-8" else \
+                codecs.getincrementaldecoder(charset)(errors="replace")
+        except LookupError:
+            decoder = None
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file:
+                for chunk in iter(lambda: response.read(65536), b""):
+                    file.write(decoder.decode(chunk).encode("utf-8") if decoder else chunk)
+                if decoder:
+                    file.write(decoder.decode(b"", final=True).encode("utf-8"))
+            os.replace(temp, body)
+        except BaseException:
+            os.unlink(temp)
+            raise
+        with open(meta, "w") as file:
+            json.dump({
+                "url": response.geturl(),
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }, file)
+
+
+def ldap_escape(value: str) -> str:
+    """escapes a value for a LDAP filter (RFC 4515), like ldap.filter.escape_filter_chars"""
+    for char, escaped in (("\\", r"\5c"), ("*", r"\2a"), ("(", r"\28"), (")", r"\29"), ("\0", r"\00")):
+        value = value.replace(char, escaped)
+    return value
+
+
+def is_uid(user: str) -> bool:
+    """checks whether a mention can be a LDAP uid at all (no mail address, no spaces)"""
+    return re.match(r"^[\w.-]+$", user) is not None
+
+
+def german_date(date) -> str:
+    """formats a date like '16. Oktober 2019' without depending on the locale"""
+    return "{:02d}. {} {}".format(date.day, GERMAN_MONTHS[date.month - 1], date.year)
+
+
+LIST_ITEM_RE = re.compile(r"^[-*•]\s+(.*)$")
+
+_templates = {}
+
+
+def load_template(path: str) -> Template:
+    """reads and compiles a template only once per run"""
+    if path not in _templates:
+        with open(path, "r", encoding="utf-8") as file:
+            _templates[path] = Template(file.read())
+    return _templates[path]
+
+
+def text_blocks(lines) -> list:
+    """groups the lines of a TOP into ("list", items) and ("paragraph", lines) blocks"""
+    blocks = []
+    previous = False
+    for line in lines:
+        stripped = line.strip()
+        item = LIST_ITEM_RE.match(stripped)
+        if not stripped:
+            kind = None
+        elif item:
+            kind = "list"
+            stripped = item.group(1)
+        elif blocks and blocks[-1][0] == "list" and line[:1].isspace() and previous:
+            # indented continuation of a list item
+            blocks[-1][1][-1] += " " + stripped
+            continue
+        else:
+            kind = "paragraph"
+        if kind is not None:
+            if not blocks or blocks[-1][0] != kind or not previous:
+                blocks.append((kind, []))
+            blocks[-1][1].append(stripped)
+        previous = kind is not None
+    return blocks
+
+
+def mention_name(mention: str) -> str:
+    """the name shown for a ${...} mention, mail addresses are dropped if a name is given"""
+    if "@" not in mention:
+        return mention
+    name = " ".join(part for part in mention.split() if "@" not in part)
+    return name or mention
+
+
+class OutputBackend(object):
+    """
+    Converts a parsed protocol into an official protocol. Subclasses define
+    the template, the escaping and how sections, paragraphs, lists and
+    mentions are written.
+    """
+
+    extension = None
+    defaults = {"simo": "xxx", "protokoll": "xxx", "beginn": "18:15 Uhr", "ende": "xx:xx Uhr"}
+
+    def __init__(self, template_dir=TEMPLATE_DIR):
+        self.template = load_template(os.path.join(template_dir, "vorlage." + self.extension))
+
+    def render(self, protocol) -> str:
+        header = protocol.document.header if protocol.document is not None else {}
+        fields = {}
+        for key, default in self.defaults.items():
+            value = MENTION_RE.sub("", header.get(key.capitalize(), "")).strip()
+            fields[key] = self.escape(value) if value else default
+        date = datetime.datetime.strptime(os.path.basename(protocol.path).split(".")[0], "%Y-%m-%d")
+        sections = "".join(self.section(top) for top in protocol.tops)
+        # safe_substitute() keeps a $ that is no placeholder, e.g. TeX math in a template
+        return self.template.safe_substitute(fields, datum=self.escape(german_date(date)), sections=sections)
+
+    def section(self, top) -> str:
+        blocks = text_blocks(top.lines[top.title.end:top.end])
+        body = "\n\n".join(
+            self.list([self.inline(item) for item in lines]) if kind == "list"
+            else self.paragraph([self.inline(line) for line in lines])
+            for kind, lines in blocks
+        )
+        return self.heading(self.escape(top.title.plain_text()), body)
+
+    def inline(self, text: str) -> str:
+        """escapes a line of text and renders its mentions"""
+        parts = MENTION_RE.split(text)
+        return "".join(
+            self.mention(self.escape(mention_name(part))) if k % 2 else self.escape(part)
+            for k, part in enumerate(parts)
+        )
+
+    def escape(self, text: str) -> str:
+        return text
+
+    def mention(self, name: str) -> str:
+        return name
+
+
+class TexBackend(OutputBackend):
+    extension = "tex"
+    escapes = {
+        "\\": r"\textbackslash{}", "&": r"\&", "%": r"\%", "$": r"\$", "#": r"\#", "_": r"\_",
+        "{": r"\{", "}": r"\}", "~": r"\textasciitilde{}", "^": r"\textasciicircum{}",
+    }
+    escape_re = re.compile("|".join(re.escape(char) for char in escapes))
+
+    def escape(self, text):
+        return self.escape_re.sub(lambda match: self.escapes[match.group(0)], text)
+
+    def heading(self, title, body):
+        return "\\section{" + title + "}\n" + body + "\n\n"
+
+    def paragraph(self, lines):
+        return "\n".join(lines)
+
+    def list(self, items):
+        return "\\begin{itemize}\n" + "".join("    \\item " + item + "\n" for item in items) + "\\end{itemize}"
+
+
+class MarkdownBackend(OutputBackend):
+    extension = "md"
+    escape_re = re.compile(r"([\\`*_\[\]<>#|])")
+
+    def escape(self, text):
+        return self.escape_re.sub(r"\\\1", text)
+
+    def heading(self, title, body):
+        return "## " + title + "\n\n" + body + "\n\n"
+
+    def paragraph(self, lines):
+        # two trailing spaces keep the line breaks of the protocol
+        return "  \n".join(lines)
+
+    def list(self, items):
+        return "\n".join("- " + item for item in items)
+
+    def mention(self, name):
+        return "**" + name + "**"
+
+
+class HtmlBackend(OutputBackend):
+    extension = "html"
+
+    def escape(self, text):
+        import html
+        return html.escape(text, quote=True)
+
+    def heading(self, title, body):
+        return "<h2>" + title + "</h2>\n" + body + "\n"
+
+    def paragraph(self, lines):
+        return "<p>" + "<br>\n".join(lines) + "</p>"
+
+    def list(self, items):
+        return "<ul>\n" + "".join("  <li>" + item + "</li>\n" for item in items) + "</ul>"
+
+    def mention(self, name):
+        return '<span class="mention">' + name + "</span>"
+
+
+OUTPUT_BACKENDS = {
+    "tex": TexBackend,
+    "md": MarkdownBackend,
+    "html": HtmlBackend,
+}
+
+
+def build_pdf(path: str):
+    """runs latexmk on a .tex file unless its content is unchanged since the last successful build"""
+    with open(path, "rb") as file:
+        digest = hashlib.sha256(file.read()).hexdigest()
+    stamp = sidecar_path(path, "sha256")
+    if os.path.isfile(path[:-4] + ".pdf") and os.path.isfile(stamp):
+        with open(stamp, "r") as file:
+            if file.read().strip() == digest:
+                print("Die .tex Datei hat sich nicht geändert, das PDF ist aktuell.")
+                return
+    directory, filename = os.path.split(path)
+    try:
+        run_command(
+            ["latexmk", "-pdf", "-interaction=nonstopmode", "-quiet", filename],
+            cwd=directory or None,
+            stdout=subprocess.DEVNULL,
+        )
+    except (subprocess.CalledProcessError, OSError) as exception:
+        print("Das PDF konnte nicht erstellt werden: {}".format(exception))
+        return
+    with open(stamp, "w") as file:
+        file.write(digest + "\n")
+    print("PDF {} erstellt.".format(path[:-4] + ".pdf"))
+
+
+class TOP_Title:
+    __slots__ = ("start", "end", "title_text")
+
+    def __init__(self, start, end, title_text):
+        self.start = start
+        self.end = end
+        self.title_text = title_text
+
+    def __str__(self):
+        return_str = ""
+        if self.title_text:
+            length = len(self.title_text)
+            return_str = "=" * length
+            return_str += "\n" + self.title_text + "\n"
+            return_str += "=" * length
+        return return_str
+
+    def list(self):
+        return str(self).split("\n")
+
+    def plain_text(self) -> str:
+        """title without the TOP number"""
+        return re.sub(r'(?i)^\s*TOP\s+\d+:\s*', '', self.title_text).strip()
+
+    def rename(self, number):
+        if not re.search(r'(?i)TOP\s+\d+:', self.title_text):
+            self.title_text = "TOP {}: {}".format(number, self.title_text)
+
+PROTOCOL_NAME_RE = re.compile(r"^20\d{2}-(0[1-9]|1[0-2])-(0[1-9]|[12]\d|3[01])\.txt$")
+
+
+def find_protocols(patterns: list) -> list:
+    """all protocols (yyyy-mm-dd.txt) in the given directories or glob patterns"""
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*.txt")
+        paths.update(path for path in glob.glob(pattern) if PROTOCOL_NAME_RE.match(os.path.basename(path)))
+    return sorted(paths)
+
+
+def is_duded(path: str) -> bool:
+    """checks for the :Protocoldude: marker by reading only the first line, in any encoding"""
+    with open(path, "rb") as file:
+        return b":Protocoldude:" in file.readline()
+
+
+class ProtocolBuffer(object):
+    """
+    The encoded protocol as one immutable bytes object and the offsets of its
+    lines. Lines are only decoded when they are accessed. The encoding (UTF-8
+    with or without BOM, otherwise Latin-1) and the newline style of the
+    original are kept for writing the protocol back.
+    """
+
+    __slots__ = ("data", "offsets", "encoding", "newline", "source")
+
+    def __init__(self, data: bytes, source=None):
+        self.data = data
+        # (path, size, mtime) of the file the data was read from
+        self.source = source
+        try:
+            data.decode("utf-8")
+            self.encoding = "utf-8"
+        except UnicodeDecodeError:
+            self.encoding = "latin-1"
+        # a byte order mark is kept in front of the first line
+        bom = 3 if data.startswith(b"\xef\xbb\xbf") else 0
+        # offsets[k] is the start of line k, offsets[k + 1] - 1 its end
+        self.offsets = offsets = array.array("q", [bom])
+        position = data.find(b"\n")
+        while position != -1:
+            offsets.append(position + 1)
+            position = data.find(b"\n", position + 1)
+        if len(data) > offsets[-1]:
+            offsets.append(len(data) + 1)
+        self.newline = b"\r\n" if len(offsets) > 1 and data[offsets[1] - 2:offsets[1]] == b"\r\n" else b"\n"
+
+    @classmethod
+    def from_file(cls, path: str):
+        with open(path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            return cls(file.read(), (os.path.abspath(path), stat.st_size, stat.st_mtime_ns))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def line(self, index: int) -> str:
+        line = self.data[self.offsets[index]:self.offsets[index + 1] - 1]
+        return (line[:-1] if line.endswith(b"\r") else line).decode(self.encoding, errors="replace")
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.line(k) for k in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("line index out of range")
+        return self.line(index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.line(index)
+
+
+def keep_mode(temp: str, path: str):
+    """gives a temporary file (mkstemp creates them 0600) the mode of the file it replaces"""
+    try:
+        os.chmod(temp, os.stat(path).st_mode & 0o7777)
+    except FileNotFoundError:
+        # the file is written for the first time
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temp, 0o666 & ~umask)
+
+
+def replace_file(path: str, text: str):
+    """writes text to a temporary file in the same folder and renames it over path"""
+    import tempfile
+    fd, temp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix="." + os.path.basename(path) + ".",
+                                suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            file.write(text)
+            file.flush()
+            os.fsync(file.fileno())
+        keep_mode(temp, path)
+        os.replace(temp, path)
+    except BaseException:
+        os.unlink(temp)
+        raise
+
+
+def write_protocol(path: str, buffer: ProtocolBuffer, edits: dict, header=()):
+    """
+    Writes the protocol with the header lines in front and the edited lines
+    (line index -> text) replaced. Unchanged ranges are copied with
+    os.sendfile from the original file if it was not changed since it was
+    read, otherwise from the buffer. The result is written to a temporary file
+    in the same folder, synced and renamed over the original, so a crash never
+    leaves a half written protocol behind.
+    """
+    import tempfile
+    directory = os.path.dirname(os.path.abspath(path))
+    newline = buffer.newline
+    encoding = buffer.encoding
+    data = memoryview(buffer.data)
+    fd, temp = tempfile.mkstemp(dir=directory, prefix="." + os.path.basename(path) + ".", suffix=".tmp")
+    source = None
+    try:
+        source = open_source(buffer)
+        write_all(fd, data[:buffer.offsets[0]])
+        write_all(fd, b"".join(line.encode(encoding, errors="replace") + newline for line in header))
+        position = buffer.offsets[0]
+        for index in sorted(edits):
+            start, end = buffer.offsets[index], buffer.offsets[index + 1]
+            copy_range(fd, source, data, position, start)
+            # keep the line ending of the replaced line
+            ending = bytes(data[start:end][-2:]) if end <= len(data) else b""
+            ending = ending if ending == b"\r\n" else ending[-1:]
+            write_all(fd, edits[index].encode(encoding, errors="replace") + ending)
+            position = min(end, len(data))
+        copy_range(fd, source, data, position, len(data))
+        os.fsync(fd)
+        keep_mode(temp, path)
+    except BaseException:
+        os.close(fd)
+        os.unlink(temp)
+        raise
+    finally:
+        if source is not None:
+            source.close()
+    os.close(fd)
+    os.replace(temp, path)
+    # make the rename itself durable
+    directory_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+
+
+def open_source(buffer: ProtocolBuffer):
+    """the file the buffer was read from, None if it is gone or was changed since"""
+    if buffer.source is None or not hasattr(os, "sendfile"):
+        return None
+    path, size, mtime = buffer.source
+    try:
+        file = open(path, "rb")
+    except OSError:
+        return None
+    stat = os.fstat(file.fileno())
+    if (stat.st_size, stat.st_mtime_ns) != (size, mtime):
+        file.close()
+        return None
+    return file
+
+
+def copy_range(fd: int, source, data: memoryview, start: int, end: int):
+    """copies the bytes start to end of the protocol, in the kernel if possible"""
+    while source is not None and start < end:
+        try:
+            sent = os.sendfile(fd, source.fileno(), start, end - start)
+        except OSError:
+            # e.g. file systems without sendfile support, copy the rest from memory
+            break
+        if sent == 0:
+            break
+        start += sent
+    write_all(fd, data[start:end])
+
+
+def write_all(fd: int, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+class TopSpan(object):
+    """position of a TOP in the protocol, end is exclusive"""
+
+    __slots__ = ("number", "start", "end", "title")
+
+    def __init__(self, number, start, end, title):
+        self.number = number
+        self.start = start
+        self.end = end
+        self.title = title
+
+
+class Mention(object):
+    """a ${...} mention, top is the index of its TOP or -1 in front of the first TOP"""
+
+    __slots__ = ("top", "line", "column", "text")
+
+    def __init__(self, top, line, column, text):
+        self.top = top
+        self.line = line
+        self.column = column
+        self.text = text
+
+
+class MentionTable(object):
+    """
+    All ${...} mentions of a protocol in columns. The mentions are sorted by
+    line, so the mentions of a TOP are a contiguous range of the table.
+    """
+
+    __slots__ = ("top", "line", "column", "text")
+
+    def __init__(self):
+        self.top = array.array("i")
+        self.line = array.array("i")
+        self.column = array.array("i")
+        self.text = []
+
+    def append(self, top, line, column, text):
+        self.top.append(top)
+        self.line.append(line)
+        self.column.append(column)
+        self.text.append(text)
+
+    def move_to(self, top, start):
+        """assigns the mentions from line start on to the TOP with the given index"""
+        k = len(self.text) - 1
+        while k >= 0 and self.line[k] >= start:
+            self.top[k] = top
+            k -= 1
+
+    def texts(self, top) -> list:
+        """the mentioned users of the TOP with the given index"""
+        return self.text[bisect.bisect_left(self.top, top):bisect.bisect_right(self.top, top)]
+
+    def __len__(self):
+        return len(self.text)
+
+    def __getitem__(self, index):
+        return Mention(self.top[index], self.line[index], self.column[index], self.text[index])
+
+    def __iter__(self):
+        for index in range(len(self.text)):
+            yield self[index]
+
+
+class ProtocolDocument(object):
+    """structure of a protocol as found by parse_protocol()"""
+
+    __slots__ = ("header", "tops", "mentions", "length")
+
+    def __init__(self):
+        self.header = {}
+        self.tops = []
+        self.mentions = MentionTable()
+        self.length = 0
+
+
+def parse_protocol(lines) -> ProtocolDocument:
+    """
+    Parses a protocol in a single pass over an iterable of lines. Only the two
+    previous lines are kept, so files can be streamed. Collects the header
+    fields in front of the first TOP, the TOP titles with their line spans and
+    every ${...} mention with its position.
+    """
+    with PROFILER.span("parse_protocol", "parse") as span:
+        document = _parse_protocol(lines)
+        span["lines"] = document.length
+    return document
+
+
+def _parse_protocol(lines) -> ProtocolDocument:
+    document = ProtocolDocument()
+    tops = document.tops
+    mentions = document.mentions
+    before_last = last = None
+    title_end = -1
+    index = -1
+
+    for index, line in enumerate(lines):
+        # a title is a line framed by two lines of '===', the closing one can't open another title
+        if line.startswith("===") and index - 2 > title_end and before_last.startswith("==="):
+            start = index - 2
+            if tops:
+                tops[-1].end = start - 1
+            tops.append(TopSpan(len(tops) + 1, start, None, last))
+            title_end = index
+            # the title lines were scanned before the title was recognized
+            mentions.move_to(len(tops) - 1, start)
+        elif not tops:
+            match = HEADER_RE.match(line)
+            if match:
+                document.header[match.group(1)] = match.group(2)
+        if "${" in line:
+            for match in MENTION_RE.finditer(line):
+                mentions.append(len(tops) - 1, index, match.start(1), match.group(1))
+        before_last, last = last, line
+
+    document.length = index + 1
+    if tops:
+        tops[-1].end = document.length
+    return document
+
+
+def parse_file(path) -> ProtocolDocument:
+    """parses a protocol file without reading it into memory at once"""
+    with open(path, "r") as file:
+        return parse_protocol(line.rstrip("\r\n") for line in file)
+
+
+def add_options(parser):
+    parser.add_argument(
+        "--disable-svn",
+        help="Schaltet die SVN/Git Interaktion ab.",
+        action="store_true",
+        dest="disable_svn",
+    )
+    parser.add_argument(
+        "--disable-tex",
+        help="Unterdruckt die Erstellung eines .tex Templates als offizielles Protokoll. So wird auch eine bereits existierende Datei nicht uberschrieben",
+        action="store_true",
+        dest="disable_tex",
+    )
+    parser.add_argument(
+        "--format",
+        help="Format des offiziellen Protokolls.",
+        choices=sorted(OUTPUT_BACKENDS),
+        default="tex",
+        dest="output_format",
+    )
+    parser.add_argument(
+        "--template-dir",
+        help="Ordner mit den Vorlagen vorlage.tex, vorlage.md und vorlage.html.",
+        action="store",
+        default=TEMPLATE_DIR,
+        dest="template_dir",
+    )
+    parser.add_argument(
+        "--pdf",
+        help="Erstellt mit latexmk ein PDF aus der .tex Datei, sofern sie sich geändert hat.",
+        action="store_true",
+        dest="build_pdf",
+    )
+    parser.add_argument(
+        "--vcs",
+        help="Versionskontrolle für das Protokoll und die erzeugten Dateien, 'auto' erkennt SVN und Git.",
+        choices=["auto"] + sorted(VCS_BACKENDS),
+        default="auto",
+        dest="vcs",
+    )
+    parser.add_argument(
+        "--disable-path-checking",
+        help="Verhindert eine Überprüfung des angegebenen Dateinamens.",
+        action="store_true",
+        dest="disable_path_check",
+    )
+    parser.add_argument(
+        "--disable-mail",
+        help="Unterdrückt das Senden von Mails.",
+        action="store_true",
+        dest="disable_mail",
+    )
+    parser.add_argument(
+        "--enable-svn",
+        help="Schaltet die SVN/Git Interaktion ein.",
+        action="store_false",
+        dest="disable_svn",
+    )
+    parser.add_argument(
+        "--enable-tex",
+        help="Erstelle eines .tex Templates als offizielles Protokoll.",
+        action="store_false",
+        dest="disable_tex",
+    )
+    parser.add_argument(
+        "--enable-path-checking",
+        help="Überprüfung des angegebenen Dateinamens",
+        action="store_false",
+        dest="disable_path_check",
+    )
+    parser.add_argument(
+        "--enable-mail",
+        help="Aktiviere das Senden von Mails.",
+        action="store_false",
+        dest="disable_mail",
+    )
+    parser.add_argument(
+        "--fromaddr",
+        help="Setze den Absender für die zu erstellenden Mails.",
+        action="store",
+        default="simo@mathphys.stura.uni-heidelberg.de",
+        dest="from_address",
+    )
+    parser.add_argument(
+        "--mail-subject",
+        help="Ändere den Betreff für die zu erstellenden Mails.",
+        action="store",
+        default="Gemeinsame Sitzung",
+        dest="mail_subject_prefix",
+    )
+    parser.add_argument(
+        "--smtp-server",
+        help="Verschickt alle Mails über diesen SMTP Server (host[:port]) ohne Anmeldung, z.B. zum Testen.",
+        action="store",
+        default="",
+        dest="smtp_server",
+    )
+    parser.add_argument(
+        "--digest",
+        help="Fasst alle TOPs für denselben Empfänger in einer Mail zusammen.",
+        action="store_true",
+        dest="digest",
+    )
+    parser.add_argument(
+        "--smtp-workers",
+        help="Anzahl paralleler SMTP Verbindungen für den Mailversand.",
+        action="store",
+        type=int,
+        default=SMTP_WORKERS,
+        dest="smtp_workers",
+    )
+    parser.add_argument(
+        "--spool",
+        help="Schreibt die Mails in einen Maildir-Ordner (oder eine .mbox Datei), statt sie zu verschicken."
+             " Verschickt werden sie dann mit 'dude.py flush <spool>'.",
+        action="store",
+        default=None,
+        dest="spool",
+    )
+    parser.add_argument(
+        "--smtp-rate",
+        help="Höchstens so viele Mails pro Sekunde über das Relay verschicken (0 = unbegrenzt).",
+        action="store",
+        type=float,
+        default=SMTP_RATE,
+        dest="smtp_rate",
+    )
+    parser.add_argument(
+        "--smtp-domain-rate",
+        help="Höchstens so viele Mails pro Sekunde an dieselbe Empfänger-Domain (0 = unbegrenzt).",
+        action="store",
+        type=float,
+        default=SMTP_DOMAIN_RATE,
+        dest="smtp_domain_rate",
+    )
+    parser.add_argument(
+        "--unknown-users",
+        help="Umgang mit unbekannten Empfängern: gesammelt nachfragen (ask), überspringen (skip),"
+             " abbrechen (fail) oder den besten Vorschlag übernehmen (auto).",
+        choices=["ask", "skip", "fail", "auto"],
+        default="ask",
+        dest="unknown_policy",
+    )
+    parser.add_argument(
+        "--auto-accept",
+        help="Minimale Ähnlichkeit (0 bis 1), ab der --unknown-users=auto einen Vorschlag übernimmt.",
+        action="store",
+        type=float,
+        default=AUTO_ACCEPT_SCORE,
+        dest="auto_accept",
+    )
+    parser.add_argument(
+        "--list-dedup",
+        help="Umgang mit Empfängern, die ein TOP schon über eine erwähnte Mailing-Liste bekommen: keine eigene Mail"
+             " (skip), nur zählen (report) oder trotzdem eine eigene Mail (off).",
+        choices=["skip", "report", "off"],
+        # off until the group entries below MATHPHYS_LDAP_GROUP_DN are confirmed for the mailing lists
+        default="off",
+        dest="list_dedup",
+    )
+    parser.add_argument(
+        "--list-members",
+        help="Datei mit den Mitgliedern der Mailing-Listen (Abschnitt [listen], z.B. 'fsr = alice, bob')."
+             " Für Listen, die darin fehlen, werden die Gruppen im LDAP gefragt.",
+        action="store",
+        default=LIST_MEMBERS_FILE,
+        dest="list_members",
+    )
+    parser.add_argument(
+        "--full-resend",
+        help="Verschickt bei einem bereits gedudeten Protokoll alle Mails erneut statt nur die zu geänderten TOPs.",
+        action="store_true",
+        dest="full_resend",
+    )
+    parser.add_argument(
+        "--profile",
+        help="Misst die Dauer von LDAP-Anfragen, Mailversand, SVN und allen Schritten und gibt eine Übersicht aus.",
+        action="store_true",
+        dest="profile",
+    )
+    parser.add_argument(
+        "--profile-trace",
+        help="Schreibt die Messungen von --profile zusätzlich im Chrome-Trace-Format in diese Datei.",
+        action="store",
+        default="",
+        metavar="<datei.json>",
+        dest="profile_trace",
+    )
+    parser.add_argument(
+        "--dump-outbox",
+        help="Zeigt das Versandprotokoll aller Mails zu diesem Protokoll an, ohne etwas zu verschicken.",
+        action="store_true",
+        dest="dump_outbox",
+    )
+    parser.add_argument(
+        "--offline",
+        help="Fragt das LDAP nicht ab, sondern verwendet nur den lokalen Empfänger-Cache.",
+        action="store_true",
+        dest="offline",
+    )
+    parser.add_argument(
+        "--refresh-cache",
+        help="Ignoriert den lokalen Empfänger-Cache und fragt alle Nutzer neu im LDAP ab.",
+        action="store_true",
+        dest="refresh_cache",
+    )
+    parser.add_argument(
+        "--download-timeout",
+        help="Timeout in Sekunden beim Herunterladen eines Protokolls von einem Pad.",
+        action="store",
+        type=float,
+        default=DOWNLOAD_TIMEOUT,
+        dest="download_timeout",
+    )
+    parser.add_argument(
+        "--disable-cache",
+        help="Verwendet keinen lokalen Empfänger-Cache.",
+        action="store_true",
+        dest="disable_cache",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        help="Gültigkeit der Einträge im Empfänger-Cache in Tagen.",
+        action="store",
+        type=float,
+        default=CACHE_TTL,
+        dest="cache_ttl",
+    )
+    parser.add_argument(
+        "-v",
+        "--version",
+        help="Gib die Version an ohne das Programm auszuführen.",
+        action="version",
+        version=__version__,
+    )
+
+
+def load_config(parser):
+    if os.path.isfile('config.ini'):
+        config = configparser.ConfigParser()
+        config.read('config.ini')
+        defaults = dict(config['default'])
+        for key in defaults:
+            if defaults[key]=='True':
+                defaults.update({key: True})
+            elif defaults[key]=='False':
+                defaults.update({key: False})
+        parser.set_defaults(**defaults)
+
+
+def main():
+    # comment to disables error messages
+    # sys.tracebacklimit = 0
+
+    parser = argparse.ArgumentParser(description='''
+        Der Protocoldude macht automagisch aus deinem schnell zusammen geschriebenen inoffiziellen Protokoll eine ansehnliche Version.
+        Außerdem werden auf seltsame Weise Erinnerungs-Maills versandt.
+        Gib dazu folgenden Befehl im Zielordner mit vorhandenem Protokoll ein:
+            $ python3 protocoldude.py yyyy-mm-dd.txt
+        Damit der ganze Spaß funktioniert, solltest du aber trotzdem ein paar Formalia beachten. Dazu gehören:
+        - Überschriften erfüllen die Form:
+                ===
+                TOP: <name>
+                ===
+        - Zu benachrichtigende Personen werden erwähnt:
+                ${<intern>}
+                ${<external@some.com>}
+        Mehrere Protokolle auf einmal bearbeitest du mit:
+            $ python3 protocoldude.py batch <ordner>
+        Das Archiv durchsuchst du mit:
+            $ python3 protocoldude.py search <suche> --archive <ordner>
+        Statistiken über das Archiv bekommst du mit:
+            $ python3 protocoldude.py stats --archive <ordner>
+        Für andere Programme exportierst du alle TOPs als NDJSON mit:
+            $ python3 protocoldude.py export --archive <ordner> -o tops.ndjson
+        ''',
+        epilog="Wer schlau ist, liest zwischen den Zeilen (oder im Code).")
+    parser.add_argument(
+        "infile",
+        metavar="<file>",
+        help="Pfad zum Protokoll. Die angegebene Datei muss folgende Benennung haben: 'yyyy-mm-dd.txt'",
+    )
+    add_options(parser)
+
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        return SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+
+    if len(sys.argv)==1: # print help message if no arguments were given
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+
+    load_config(parser)
+    args = parser.parse_args()
+
+    if args.dump_outbox:
+        Outbox(outbox_path(args.infile)).dump()
+        return
+
+    start_profiler(args)
+    protocol = Protocol(args, create_resolver(args))
+    try:
+        run(protocol, args)
+    finally:
+        print(protocol.resolver.stats())
+        protocol.resolver.close()
+        stop_profiler(args)
+
+def run(protocol, args, connect=None):
+    timer = StageTimer()
+    vcs = None
+    if not args.disable_svn:
+        vcs = create_vcs(args.vcs, protocol.path)
+        vcs.start_update()
+
+    if protocol.check_dude():
+        print("Das Protokoll wurde bereits gedudet.")
+        if protocol.has_fingerprints() and not args.full_resend:
+            protocol.incremental = True
+        elif input("Bist du sicher, dass du Leuten nochmal nervige SPAM Mails schicken willst? [j/N]") != "j":
+            if vcs is not None:
+                error = wait_for_update(vcs)
+                if error is not None:
+                    print("Das {}-Update ist fehlgeschlagen: {}".format(vcs.name.upper(), error))
+            return
+        else:
+            protocol.resend = True
+    if not args.disable_path_check:
+        protocol.check_path()
+    with timer.stage("Protokoll einlesen"):
+        protocol.get_tops()
+        if protocol.incremental:
+            changed = protocol.select_changed()
+            print("Seit dem letzten Aufruf wurden {} TOPs geändert. Mails gehen nur an neu erwähnte Personen"
+                  " und zu neuen oder geänderten TOPs.".format(changed))
+        protocol.rename_title()
+    if vcs is not None:
+        # nothing is written into the working copy before the update is done, its errors are reported by publish()
+        with timer.stage("{}-Update".format(vcs.name.upper())):
+            wait_for_update(vcs)
+        if protocol.changed_on_disk():
+            print("Das Update hat das Protokoll geändert, es wird neu eingelesen.")
+            return run(Protocol(args, protocol.resolver), args, connect)
+
+    # the template is written before any mail is sent, so an error in it stops the run in time;
+    # only the slow PDF build runs while the mails are sent
+    pdf = None
     if not args.disable_tex:
-        protocol.official()
+        with timer.stage("TeX-Vorlage"):
+            protocol.official(pdf=False)
+        if args.build_pdf and protocol.output_path().endswith(".tex"):
+            pdf = timer.background("PDF", build_pdf, protocol.output_path())
     else:
         print("Keine .tex Datei als offizielle Protokollvorlage erstellt.")
     if not args.disable_mail:
         # protocol.remind()
-        protocol.send_mails()
+        with timer.stage("Empfänger und Mailversand"):
+            protocol.send_mails(connect)
     else:
+        with timer.stage("Empfänger"):
+            protocol.get_users()
         print("Mailversand nicht aktiviert!")
-    protocol.write_success()
-    if not args.disable_svn:
-        protocol.svn_interaction()
+    if pdf is not None:
+        pdf.join()
+    with timer.stage("Speichern"):
+        protocol.write_success()
+    if vcs is not None:
+        with timer.stage(vcs.name.upper()):
+            protocol.svn_interaction(vcs)
     else:
         print("Nichts ins SVN commited!")
+    timer.report()
+
+
+class Profiler(object):
+    """
+    Records duration, count and size of the expensive operations of a run
+    (stages, LDAP searches, SMTP transactions, svn calls). Does nothing
+    unless enabled with --profile.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.origin = time.perf_counter()
+        self.events = []
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, category, **args):
+        """measures the enclosed block, the yielded dict takes additional values like bytes"""
+        if not self.enabled:
+            yield args
+            return
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            event = {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": (start - self.origin) * 1e6,
+                "dur": (time.perf_counter() - start) * 1e6,
+                "pid": os.getpid(),
+                "tid": threading.get_ident(),
+                "args": args,
+            }
+            with self.lock:
+                self.events.append(event)
+
+    def report(self, out=sys.stdout):
+        summary = collections.OrderedDict()
+        for event in self.events:
+            entry = summary.setdefault((event["cat"], event["name"]), [0, 0.0, 0.0, 0])
+            entry[0] += 1
+            entry[1] += event["dur"] / 1e6
+            entry[2] = max(entry[2], event["dur"] / 1e6)
+            entry[3] += event["args"].get("bytes", 0)
+        print("\n{:<8} {:<28} {:>7} {:>10} {:>10} {:>10}".format(
+            "Bereich", "Vorgang", "Anzahl", "Gesamt [s]", "Max [s]", "Bytes"), file=out)
+        for (category, name), (count, total, longest, size) in summary.items():
+            print("{:<8} {:<28} {:>7} {:>10.3f} {:>10.3f} {:>10}".format(
+                category, name, count, total, longest, size or ""), file=out)
+
+    def write_trace(self, path):
+        """writes the events in the Chrome trace format (chrome://tracing, Perfetto)"""
+        with open(path, "w") as file:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, file, default=str)
+
+
+PROFILER = Profiler()
+
+
+def run_command(command, **kwargs):
+    """subprocess.run() with check=True, recorded by the profiler"""
+    with PROFILER.span(" ".join(command[:2]), "process"):
+        return subprocess.run(command, check=True, **kwargs)
+
+
+class VcsError(Exception):
+    """a failed version control command with its exit code and output"""
+
+    def __init__(self, action, command, returncode=None, output=""):
+        super().__init__(action, command, returncode, output)
+        self.action = action
+        self.command = command
+        self.returncode = returncode
+        self.output = output
+
+    def __str__(self):
+        status = "Exit-Code {}".format(self.returncode) if self.returncode is not None else "nicht ausführbar"
+        message = "'{}' ist fehlgeschlagen ({})".format(" ".join(self.command), status)
+        return message + (":\n    " + self.output.replace("\n", "\n    ") if self.output else ".")
+
+
+class Vcs(object):
+    """
+    Interface of the version control backends. The update runs in the
+    background from the start of a run, all files of a run are added with one
+    call and committed together.
+    """
+
+    name = None
+    # shown if something went wrong
+    repair_hint = ""
+
+    def __init__(self, directory="."):
+        self.directory = directory
+        self.updating = None
+
+    def start_update(self):
+        import concurrent.futures
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.updating = executor.submit(self.update)
+        executor.shutdown(wait=False)
+
+    def wait_update(self):
+        """waits for the background update, raises its VcsError"""
+        if self.updating is None:
+            self.update()
+        else:
+            self.updating.result()
+
+    def publish(self, paths: list, message: str):
+        self.wait_update()
+        paths = [os.path.abspath(path) for path in paths]
+        self.add(paths)
+        self.commit(paths, message)
+
+    def run(self, action, command):
+        try:
+            return run_command(command, cwd=self.directory, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               universal_newlines=True)
+        except subprocess.CalledProcessError as error:
+            raise VcsError(action, command, error.returncode, (error.stderr or error.stdout or "").strip())
+        except OSError as error:
+            raise VcsError(action, command, None, str(error))
+
+    def update(self):
+        raise NotImplementedError
+
+    def add(self, paths: list):
+        raise NotImplementedError
+
+    def commit(self, paths: list, message: str):
+        raise NotImplementedError
+
+
+class SvnBackend(Vcs):
+    name = "svn"
+    repair_hint = "Das musst Du irgendwie von Hand reparieren mit 'svn cleanup' oder so."
+
+    def update(self):
+        self.run("update", ["svn", "up", "--non-interactive"])
+
+    def add(self, paths):
+        # --force skips files that are already under version control
+        self.run("add", ["svn", "add", "--force", "--parents", "--non-interactive"] + paths)
+
+    def commit(self, paths, message):
+        self.run("commit", ["svn", "commit", "--non-interactive", "-m", message] + paths)
+
+
+class GitBackend(Vcs):
+    name = "git"
+    repair_hint = "Schau mit 'git status' nach, was schief gegangen ist."
+
+    def upstream(self) -> bool:
+        try:
+            self.run("update", ["git", "rev-parse", "--abbrev-ref", "--symbolic-full-name", "@{u}"])
+        except VcsError:
+            return False
+        return True
+
+    def update(self):
+        # local repositories without upstream have nothing to update
+        if self.upstream():
+            self.run("update", ["git", "pull", "--ff-only", "--quiet"])
+
+    def add(self, paths):
+        self.run("add", ["git", "add", "--"] + paths)
+
+    def staged(self, paths) -> bool:
+        """whether the index differs from HEAD for paths, git diff exits 1 then"""
+        try:
+            self.run("commit", ["git", "diff", "--cached", "--quiet", "--"] + paths)
+        except VcsError as error:
+            if error.returncode == 1:
+                return True
+            raise
+        return False
+
+    def commit(self, paths, message):
+        # unchanged files are no error, like for svn ci
+        if not self.staged(paths):
+            return
+        self.run("commit", ["git", "commit", "--quiet", "-m", message, "--"] + paths)
+        if self.upstream():
+            self.run("commit", ["git", "push", "--quiet"])
+
+
+VCS_BACKENDS = {
+    "svn": SvnBackend,
+    "git": GitBackend,
+}
+
+
+def create_vcs(name: str, path: str) -> Vcs:
+    """the backend for the folder of path, 'auto' looks for a .svn or .git folder above it"""
+    directory = os.path.dirname(os.path.abspath(path)) if not os.path.isdir(path) else os.path.abspath(path)
+    if name == "auto":
+        name = "svn"
+        folder = directory
+        while True:
+            if os.path.isdir(os.path.join(folder, ".svn")):
+                break
+            if os.path.exists(os.path.join(folder, ".git")):
+                name = "git"
+                break
+            parent = os.path.dirname(folder)
+            if parent == folder:
+                break
+            folder = parent
+    return VCS_BACKENDS[name](directory)
+
+
+def wait_for_update(vcs: Vcs):
+    """waits for the background update, returns its VcsError instead of raising it"""
+    try:
+        vcs.wait_update()
+    except VcsError as error:
+        return error
+    return None
+
+
+def publish(vcs: Vcs, paths: list, message: str) -> bool:
+    """adds and commits the files, reports errors instead of raising them"""
+    try:
+        vcs.publish(paths, message)
+    except VcsError as error:
+        print("Konnte die Dateien nicht ins {} übertragen: {}".format(vcs.name.upper(), error))
+        print(vcs.repair_hint)
+        print("Das Protokoll wurde trotzdem bearbeitet und gespeichert.")
+        return False
+    print("Protokoll bearbeitet und in den Sumpf geschrieben.\n Für heute hast du's geschafft!")
+    return True
+
+
+class StageTimer(object):
+    """measures the wall clock time of the stages of a run, also of those running in background threads"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.durations = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            with PROFILER.span(name, "stage"):
+                yield
+        finally:
+            with self.lock:
+                self.durations[name] = self.durations.get(name, 0) + time.perf_counter() - start
+
+    def background(self, name, function, *args):
+        """runs function in a thread, the caller has to join() it, join() raises the error of function"""
+        thread = BackgroundStage(self, name, function, args)
+        thread.start()
+        return thread
+
+    def report(self):
+        total = time.perf_counter() - self.start
+        print("\nLaufzeiten:")
+        for name, duration in self.durations.items():
+            print("    {:<28} {:>7.2f} s".format(name, duration))
+        print("    {:<28} {:>7.2f} s (Summe der Schritte {:.2f} s)".format(
+            "Gesamt", total, sum(self.durations.values())))
+
+
+class BackgroundStage(threading.Thread):
+    """a stage of StageTimer running in a thread, its exception is raised again by join()"""
+
+    def __init__(self, timer, name, function, args):
+        super().__init__()
+        self.timer = timer
+        self.stage_name = name
+        self.function = function
+        self.args = args
+        self.error = None
+
+    def run(self):
+        try:
+            with self.timer.stage(self.stage_name):
+                self.function(*self.args)
+        except BaseException as exception:
+            self.error = exception
+
+    def join(self, timeout=None):
+        super().join(timeout)
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+def start_profiler(args):
+    PROFILER.enabled = args.profile or bool(args.profile_trace)
+
+
+def stop_profiler(args):
+    if PROFILER.enabled:
+        PROFILER.report()
+    if args.profile_trace:
+        PROFILER.write_trace(args.profile_trace)
+        print("Messungen in {} gespeichert.".format(args.profile_trace))
+
+
+class DirectoryWatcher(object):
+    """
+    Reports the names of changed files in a folder, through inotify if the
+    C library provides it and by comparing modification times otherwise.
+    """
+
+    # IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    INOTIFY_MASK = 0x002 | 0x008 | 0x080 | 0x100
+
+    def __init__(self, directory, poll=WATCH_POLL, inotify=True):
+        self.directory = directory
+        self.poll = poll
+        self.fd = self.inotify(directory) if inotify else None
+        self.mtimes = self.scan() if self.fd is None else {}
+
+    @classmethod
+    def inotify(cls, directory):
+        """an inotify descriptor watching directory, None where inotify is not available"""
+        import ctypes
+        import ctypes.util
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(directory), cls.INOTIFY_MASK) < 0:
+            os.close(fd)
+            return None
+        return fd
+
+    def scan(self) -> dict:
+        mtimes = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    stat = entry.stat()
+                    mtimes[entry.name] = (stat.st_mtime_ns, stat.st_size)
+        return mtimes
+
+    def changes(self, timeout=None) -> set:
+        """waits up to timeout seconds (forever if None) for changes and returns the changed names"""
+        if self.fd is None:
+            time.sleep(self.poll if timeout is None else min(timeout, self.poll))
+            mtimes = self.scan()
+            changed = {name for name, stamp in mtimes.items() if self.mtimes.get(name) != stamp}
+            self.mtimes = mtimes
+            return changed
+        import select
+        import struct
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        data = os.read(self.fd, 65536)
+        changed = set()
+        position = 0
+        while position + 16 <= len(data):
+            # struct inotify_event: int wd, uint32 mask, cookie, len, char name[len]
+            _, _, _, length = struct.unpack_from("iIII", data, position)
+            name = data[position + 16:position + 16 + length].rstrip(b"\0")
+            if name:
+                changed.add(os.fsdecode(name))
+            position += 16 + length
+        return changed
+
+    @property
+    def method(self) -> str:
+        return "inotify" if self.fd is not None else "Polling alle {} s".format(self.poll)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def watch(argv):
+    parser = argparse.ArgumentParser(
+        prog="dude.py watch",
+        description="Beobachtet einen Ordner und bearbeitet jedes fertige Protokoll (yyyy-mm-dd.txt), sobald es"
+                    " gespeichert wird. LDAP-Verbindung, Caches und SMTP-Verbindungen bleiben dazwischen offen.",
+    )
+    parser.add_argument(
+        "directory",
+        metavar="<ordner>",
+        nargs="?",
+        default=".",
+        help="Ordner mit den Protokollen",
+    )
+    parser.add_argument(
+        "--complete-when",
+        help="Regulärer Ausdruck, der im Protokoll vorkommen muss, damit es als fertig gilt."
+             " Voreinstellung: ein ausgefülltes 'Ende:'.",
+        action="store",
+        default=WATCH_COMPLETE,
+        dest="complete_when",
+    )
+    parser.add_argument(
+        "--debounce",
+        help="Sekunden ohne weitere Änderung, bevor ein gespeichertes Protokoll bearbeitet wird.",
+        action="store",
+        type=float,
+        default=WATCH_DEBOUNCE,
+        dest="debounce",
+    )
+    parser.add_argument(
+        "--poll",
+        help="Abfrageintervall in Sekunden, falls inotify nicht verfügbar ist.",
+        action="store",
+        type=float,
+        default=WATCH_POLL,
+        dest="poll",
+    )
+    parser.add_argument(
+        "--polling",
+        help="Fragt den Ordner regelmäßig ab, statt inotify zu verwenden.",
+        action="store_true",
+        dest="polling",
+    )
+    add_options(parser)
+    load_config(parser)
+    args = parser.parse_args(argv)
+    if args.unknown_policy == "ask":
+        # nobody is there to answer
+        args.unknown_policy = "skip"
+    complete = re.compile(args.complete_when)
+    start_profiler(args)
+
+    resolver = create_resolver(args)
+    connect = SmtpConnector(args.smtp_server, keep_alive=True)
+    watcher = DirectoryWatcher(args.directory, poll=args.poll, inotify=not args.polling)
+    print("Beobachte {} ({}), beenden mit Strg+C.".format(os.path.abspath(args.directory), watcher.method))
+    # content hashes of the processed protocols, rewriting them doesn't trigger another run;
+    # the protocols already there count as processed, only files changed from now on are processed
+    processed = {}
+    for name in os.listdir(args.directory):
+        path = os.path.join(args.directory, name)
+        if PROTOCOL_NAME_RE.match(name) and os.path.isfile(path):
+            with open(path, "rb") as file:
+                processed[name] = hashlib.sha256(file.read()).hexdigest()
+    pending = {}
+    try:
+        while True:
+            now = time.monotonic()
+            for name, changed in list(pending.items()):
+                if now - changed < args.debounce:
+                    continue
+                del pending[name]
+                path = os.path.join(args.directory, name)
+                if not PROTOCOL_NAME_RE.match(name) or not os.path.isfile(path):
+                    continue
+                with open(path, "rb") as file:
+                    content = file.read()
+                digest = hashlib.sha256(content).hexdigest()
+                if processed.get(name) == digest or content.startswith(b":Protocoldude:"):
+                    continue
+                if not complete.search(content.decode("utf-8", errors="replace")):
+                    continue
+                start = time.perf_counter()
+                # the name was checked already, check_path() would ask for another one
+                protocol_args = argparse.Namespace(**dict(vars(args), infile=path, disable_path_check=True))
+                resolver.forget_unknown()
+                try:
+                    run(Protocol(protocol_args, resolver), protocol_args, connect)
+                except Exception as exception:
+                    # the daemon keeps running, the protocol is tried again when it is saved next time
+                    print("{} konnte nicht bearbeitet werden: {}".format(path, exception))
+                with open(path, "rb") as file:
+                    processed[name] = hashlib.sha256(file.read()).hexdigest()
+                print("{} in {:.2f} s bearbeitet, warte auf das nächste Protokoll.".format(
+                    path, time.perf_counter() - start))
+            timeout = None
+            if pending:
+                timeout = max(0.0, min(changed + args.debounce for changed in pending.values()) - time.monotonic())
+            changed = watcher.changes(timeout)
+            now = time.monotonic()
+            for name in changed:
+                pending[name] = now
+    except KeyboardInterrupt:
+        print("\nBeendet.")
+    finally:
+        watcher.close()
+        connect.close()
+        print(resolver.stats())
+        resolver.close()
+        stop_profiler(args)
+
+
+def create_resolver(args):
+    cache = None
+    if not args.disable_cache:
+        cache = RecipientCache(ttl=args.cache_ttl, refresh=args.refresh_cache)
+    return LdapResolver(cache=cache, offline=args.offline, members_file=args.list_members)
+
+
+def prepare_protocol(args):
+    """reads and parses a protocol and writes its .tex template, runs in a worker process"""
+    protocol = Protocol(args)
+    protocol.get_tops()
+    protocol.rename_title()
+    if not args.disable_tex:
+        protocol.official()
+    return protocol
+
+
+def batch(argv):
+    parser = argparse.ArgumentParser(
+        prog="dude.py batch",
+        description="Bearbeitet alle Protokolle (yyyy-mm-dd.txt) in den angegebenen Ordnern oder Mustern parallel.",
+    )
+    parser.add_argument(
+        "patterns",
+        metavar="<ordner|muster>",
+        nargs="+",
+        help="Ordner mit Protokollen oder Muster wie 'sumpf/2019-*.txt'",
+    )
+    parser.add_argument(
+        "--jobs",
+        help="Anzahl der Prozesse, die Protokolle parallel einlesen.",
+        action="store",
+        type=int,
+        default=None,
+        dest="jobs",
+    )
+    add_options(parser)
+    load_config(parser)
+    args = parser.parse_args(argv)
+    start_profiler(args)
+
+    summary = {}
+    todo = []
+    paths = find_protocols(args.patterns)
+    vcs = None
+    if not args.disable_svn and paths:
+        vcs = create_vcs(args.vcs, paths[0])
+        vcs.start_update()
+        # the protocols are read and their templates written only after the update,
+        # its errors are reported by publish()
+        wait_for_update(vcs)
+    for path in paths:
+        try:
+            duded = is_duded(path)
+        except OSError as exception:
+            # one unreadable file doesn't stop the others
+            summary[path] = [0, 0, "Fehler: {}".format(exception)]
+            continue
+        if duded:
+            summary[path] = [0, 0, "bereits gedudet"]
+        else:
+            todo.append(argparse.Namespace(**dict(vars(args), infile=path)))
+    if not todo:
+        print("Keine ungedudeten Protokolle gefunden.")
+
+    import concurrent.futures
+    protocols = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {pool.submit(prepare_protocol, protocol_args): protocol_args.infile for protocol_args in todo}
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future]
+            try:
+                protocols.append(future.result())
+                summary[path] = [len(protocols[-1].tops), 0, "bearbeitet"]
+            except Exception as exception:
+                summary[path] = [0, 0, "Fehler: {}".format(exception)]
+    protocols.sort(key=lambda protocol: protocol.path)
+
+    # one resolver and one SMTP connector are shared by all protocols
+    resolver = create_resolver(args)
+    connect = SmtpConnector(args.smtp_server)
+    try:
+        for protocol in protocols:
+            for top in protocol.tops:
+                top.get_user()
+        resolver.resolve([user for protocol in protocols for top in protocol.tops for user in top.users])
+        for protocol in protocols:
+            protocol.resolver = resolver
+            protocol.get_users()
+
+        if not args.disable_mail:
+            owners = {top: protocol for protocol in protocols for top in protocol.tops}
+            queued = [(protocol, protocol.queue_mails()) for protocol in protocols]
+            delivery = create_delivery(args, connect, lambda result: owners[result.mail.top].mail_result(result))
+            results = delivery.deliver([mail for _, pending in queued for mail in pending or []])
+            print(delivery.stats())
+            for protocol, pending in queued:
+                if pending is None:
+                    continue
+                own = [result for result in results if owners[result.mail.top] is protocol]
+                protocol.report_mails(own, len(pending))
+                summary[protocol.path][1] = sum(top.send for top in protocol.tops)
+                if not protocol.mails_sent:
+                    summary[protocol.path][2] = "Mails fehlgeschlagen"
+        else:
+            print("Mailversand nicht aktiviert!")
+
+        for protocol in protocols:
+            protocol.write_success()
+        if vcs is not None and protocols:
+            # one commit for all protocols of the run
+            dates = ", ".join(os.path.basename(protocol.path)[:10] for protocol in protocols)
+            message = "Protokolle der {} vom {} hinzugefügt".format(args.mail_subject_prefix, dates)
+            if len(protocols) == 1:
+                message = "Protokoll der {} hinzugefügt".format(args.mail_subject_prefix)
+            publish(vcs, [path for protocol in protocols for path in protocol.generated_files()], message)
+    finally:
+        print(resolver.stats())
+        resolver.close()
+        stop_profiler(args)
+
+    width = max([len(path) for path in summary] + [5])
+    print("\n{:<{width}}  {:>5}  {:>5}  {}".format("Datei", "TOPs", "Mails", "Status", width=width))
+    for path, (tops, mails, status) in sorted(summary.items()):
+        print("{:<{width}}  {:>5}  {:>5}  {}".format(path, tops, mails, status, width=width))
+
+
+def search(argv):
+    parser = argparse.ArgumentParser(
+        prog="dude.py search",
+        description="Durchsucht alle TOPs der Protokolle im Archiv. Der Index wird vorher aktualisiert.",
+    )
+    parser.add_argument(
+        "query",
+        metavar="<suche>",
+        help="Suchbegriffe (FTS5 Syntax, z.B. 'Beschluss AND Server', 'Funk*', 'title:Finanzen') oder ${user}",
+    )
+    parser.add_argument(
+        "--archive",
+        help="Ordner oder Muster der Protokolle, die durchsucht werden.",
+        action="append",
+        default=None,
+        dest="archive",
+    )
+    parser.add_argument(
+        "--index",
+        help="Pfad der Indexdatei.",
+        action="store",
+        default=None,
+        dest="index",
+    )
+    parser.add_argument(
+        "--since",
+        help="Nur Protokolle ab diesem Datum (yyyy-mm-dd).",
+        action="store",
+        default=None,
+        dest="since",
+    )
+    parser.add_argument(
+        "--limit",
+        help="Maximale Anzahl an Treffern.",
+        action="store",
+        type=int,
+        default=20,
+        dest="limit",
+    )
+    args = parser.parse_args(argv)
+
+    index = ProtocolIndex(args.index)
+    try:
+        paths = find_protocols(args.archive or ["."])
+        indexed, unchanged, removed = index.update(paths)
+        if indexed or removed:
+            print("Index aktualisiert: {} neu eingelesen, {} unverändert, {} entfernt.".format(
+                indexed, unchanged, removed))
+        start = time.perf_counter()
+        results = index.search(args.query, since=args.since, limit=args.limit, paths=paths)
+        elapsed = time.perf_counter() - start
+    finally:
+        index.close()
+
+    for date, number, title, snippet, path in results:
+        print("{}  TOP {}: {}  ({})".format(date, number, title, os.path.relpath(path)))
+        for line in snippet.splitlines():
+            if line.strip():
+                print("    " + line.strip())
+    print("{} Treffer in {:.1f} ms.".format(len(results), elapsed * 1000))
+
+
+def stats(argv):
+    parser = argparse.ArgumentParser(
+        prog="dude.py stats",
+        description="Statistiken über alle Protokolle im Archiv: Sitzungsdauer, TOPs, Simos, Protokollanten und"
+                    " erwähnte Mailing-Listen. Nur neue und geänderte Protokolle werden dafür eingelesen.",
+    )
+    parser.add_argument(
+        "--archive",
+        help="Ordner oder Muster der Protokolle, die ausgewertet werden.",
+        action="append",
+        default=None,
+        dest="archive",
+    )
+    parser.add_argument(
+        "--store",
+        help="Pfad der Datei mit den gespeicherten Werten.",
+        action="store",
+        default=None,
+        dest="store",
+    )
+    parser.add_argument(
+        "--since",
+        help="Nur Protokolle ab diesem Datum (yyyy-mm-dd).",
+        action="store",
+        type=parse_date,
+        default=None,
+        dest="since",
+    )
+    parser.add_argument(
+        "--until",
+        help="Nur Protokolle bis zu diesem Datum (yyyy-mm-dd).",
+        action="store",
+        type=parse_date,
+        default=None,
+        dest="until",
+    )
+    parser.add_argument(
+        "--by",
+        help="Zusammenfassen pro Semester oder pro Jahr.",
+        choices=["semester", "year"],
+        default="semester",
+        dest="by",
+    )
+    parser.add_argument(
+        "--limit",
+        help="Anzahl der häufigsten Simos, Protokollanten und Mailing-Listen.",
+        action="store",
+        type=int,
+        default=5,
+        dest="limit",
+    )
+    args = parser.parse_args(argv)
+
+    store = ArchiveStats(args.store)
+    parsed, unchanged, removed = store.update(find_protocols(args.archive or ["."]))
+    if parsed or removed:
+        print("Statistik aktualisiert: {} neu eingelesen, {} unverändert, {} entfernt.".format(
+            parsed, unchanged, removed))
+    start = time.perf_counter()
+    rows = store.select(args.since, args.until)
+    sessions = store.sessions(rows, args.by)
+    simos = store.ranking("simo", rows, args.limit)
+    writers = store.ranking("writer", rows, args.limit)
+    lists = store.lists(rows, args.by, args.limit)
+    elapsed = time.perf_counter() - start
+
+    if not sessions:
+        print("Keine Protokolle in diesem Zeitraum.")
+        return
+    print("{:<14} {:>9} {:>9} {:>6} {:>8}".format("Zeitraum", "Sitzungen", "Ø Dauer", "TOPs", "Ø TOPs"))
+    for name, count, minutes, tops in sessions:
+        print("{:<14} {:>9} {:>9} {:>6} {:>8.1f}".format(
+            name, count, "{:.0f} min".format(minutes) if minutes is not None else "-", tops, tops / count))
+    print("\nSimos: " + ", ".join("{} ({})".format(name, count) for name, count in simos))
+    print("Protokolle: " + ", ".join("{} ({})".format(name, count) for name, count in writers))
+    print("\nErwähnte Mailing-Listen (Anzahl TOPs):")
+    for name, counts in lists:
+        print("    {}: {}".format(name, ", ".join("{} ({})".format(list_name, count) for list_name, count in counts)))
+    print("\n{} Protokolle in {:.1f} ms ausgewertet.".format(len(rows), elapsed * 1000))
+
+
+def parse_date(value: str) -> datetime.date:
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("'{}' ist kein Datum der Form yyyy-mm-dd.".format(value))
+
+
+def export(argv):
+    parser = argparse.ArgumentParser(
+        prog="dude.py export",
+        description="Gibt alle TOPs der Protokolle als NDJSON aus, ein JSON-Objekt pro Zeile mit Datum, Nummer,"
+                    " Titel, Text und aufgelösten Empfängern.",
+    )
+    parser.add_argument(
+        "--archive",
+        help="Ordner, Muster oder Dateien der Protokolle, die exportiert werden.",
+        action="append",
+        default=None,
+        dest="archive",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="Schreibt in diese Datei statt auf die Standardausgabe.",
+        action="store",
+        default=None,
+        dest="output",
+    )
+    parser.add_argument(
+        "--since",
+        help="Nur Protokolle ab diesem Datum (yyyy-mm-dd).",
+        action="store",
+        type=parse_date,
+        default=None,
+        dest="since",
+    )
+    parser.add_argument(
+        "--offline",
+        help="Fragt das LDAP nicht, Empfänger werden nur aus dem Cache aufgelöst.",
+        action="store_true",
+        dest="offline",
+    )
+    parser.add_argument(
+        "--disable-cache",
+        help="Verwendet den Cache der Mailadressen nicht.",
+        action="store_true",
+        dest="disable_cache",
+    )
+    args = parser.parse_args(argv)
+
+    cache = None if args.disable_cache else RecipientCache()
+    resolver = LdapResolver(cache=cache, offline=args.offline)
+    out = sys.stdout if args.output is None else open(args.output, "w", encoding="utf-8")
+    count = 0
+    try:
+        for record in export_records(find_protocols(args.archive or ["."]), resolver, args.since):
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+        out.flush()
+    except BrokenPipeError:
+        # the consumer stopped reading, e.g. 'dude.py export | head'
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        resolver.close()
+    # stdout carries the records, the summary goes to stderr
+    print("{} TOPs exportiert. {}".format(count, resolver.stats()), file=sys.stderr)
+
+
+def flush(argv):
+    parser = argparse.ArgumentParser(
+        prog="dude.py flush",
+        description="Verschickt die Mails aus einem Spool (--spool) über eine wiederverwendete SMTP Verbindung.",
+    )
+    parser.add_argument(
+        "spool",
+        metavar="<spool>",
+        help="Maildir-Ordner oder .mbox Datei",
+    )
+    parser.add_argument(
+        "--smtp-server",
+        help="SMTP Server als host[:port] statt des MathPhys- oder URZ-Relays.",
+        action="store",
+        default=None,
+        dest="smtp_server",
+    )
+    parser.add_argument(
+        "--smtp-workers",
+        help="Anzahl paralleler SMTP Verbindungen.",
+        action="store",
+        type=int,
+        default=1,
+        dest="smtp_workers",
+    )
+    parser.add_argument(
+        "--smtp-rate",
+        help="Höchstens so viele Mails pro Sekunde über das Relay verschicken (0 = unbegrenzt).",
+        action="store",
+        type=float,
+        default=SMTP_RATE,
+        dest="smtp_rate",
+    )
+    parser.add_argument(
+        "--smtp-domain-rate",
+        help="Höchstens so viele Mails pro Sekunde an dieselbe Empfänger-Domain (0 = unbegrenzt).",
+        action="store",
+        type=float,
+        default=SMTP_DOMAIN_RATE,
+        dest="smtp_domain_rate",
+    )
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.spool):
+        print("Den Spool {} gibt es nicht.".format(args.spool))
+        sys.exit(1)
+
+    spool = Spool(args.spool)
+    try:
+        mails = [SpooledMail(key, data) for key, data in spool.messages()]
+        if not mails:
+            print("Der Spool ist leer.")
+            return
+        delivery = MailDelivery(
+            SmtpConnector(args.smtp_server),
+            workers=args.smtp_workers,
+            rate=args.smtp_rate,
+            domain_rate=args.smtp_domain_rate,
+            pipelining=True,
+        )
+        results = delivery.deliver(mails)
+        failed = [result for result in results if not result.ok]
+        for result in results:
+            if result.ok:
+                spool.remove(result.mail.key)
+            else:
+                print('An "{}" ({}) konnte nicht verschickt werden: {}'.format(
+                    result.mail.address, result.mail.subject, result.error))
+        print(delivery.stats())
+        if failed:
+            print("{} Mails bleiben im Spool.".format(len(failed)))
+    finally:
+        spool.close()
+
+
+SUBCOMMANDS = {
+    "batch": batch,
+    "watch": watch,
+    "flush": flush,
+    "search": search,
+    "stats": stats,
+    "export": export,
+}
 
 if __name__ == "__main__":
     main()
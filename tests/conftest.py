@@ -0,0 +1,38 @@
+import argparse
+import os
+import sys
+
+import pytest
+
+# dude.py and the benchmarks package live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dude  # noqa: E402
+
+
+@pytest.fixture
+def make_mail():
+    """builds an OutgoingMail without TOPs to the given address"""
+    def make(address, subject="TOP 1: Finanzen", body="Hallo!"):
+        return dude.OutgoingMail([], address.partition("@")[0], address, "fsr@example.org", subject, body)
+    return make
+
+
+@pytest.fixture
+def protocol_args():
+    """parses the options of a mail run against a local SMTP server for the given protocol"""
+    def parse(path, server, *options):
+        parser = argparse.ArgumentParser()
+        parser.add_argument("infile")
+        dude.add_options(parser)
+        return parser.parse_args([
+            path,
+            "--disable-svn",
+            "--disable-cache",
+            "--unknown-users", "skip",
+            "--smtp-server", server,
+            "--smtp-workers", "1",
+            "--smtp-rate", "0",
+            "--smtp-domain-rate", "0",
+        ] + list(options))
+    return parse
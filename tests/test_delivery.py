@@ -0,0 +1,75 @@
+import time
+
+import dude
+
+from benchmarks.fakes import SmtpSink
+
+
+def test_lists_go_first_then_submission_order(make_mail):
+    scheduler = dude.SendScheduler(rate=0, domain_rate=0)
+    scheduler.put(0, make_mail("alice@example.org"))
+    scheduler.put(1, make_mail("bob@example.org"))
+    scheduler.put(2, make_mail("fsr@example.org"))
+    assert [scheduler.get()[0] for _ in range(3)] == [2, 0, 1]
+
+
+def test_deferred_mail_does_not_block_the_others(make_mail):
+    scheduler = dude.SendScheduler(rate=0, domain_rate=0)
+    scheduler.put(0, make_mail("alice@example.org"))
+    scheduler.put(1, make_mail("bob@example.org"))
+    index, attempt, mail = scheduler.get()
+    assert (index, attempt) == (0, 1)
+
+    # the relay deferred the first mail, it comes back after its backoff
+    start = time.monotonic()
+    scheduler.put(index, mail, attempt + 1, delay=0.2)
+    assert scheduler.get()[:2] == (1, 1)
+    scheduler.done()
+    assert scheduler.get()[:2] == (0, 2)
+    assert time.monotonic() - start >= 0.2
+    scheduler.done()
+
+    scheduler.close()
+    assert scheduler.get() is None
+
+
+def test_domain_rate_limit(make_mail):
+    scheduler = dude.SendScheduler(rate=0, domain_rate=20)
+    for index in range(50):
+        scheduler.put(index, make_mail("user{}@example.org".format(index)))
+    scheduler.close()
+    start = time.monotonic()
+    while scheduler.get() is not None:
+        scheduler.done()
+    # a burst of 40 mails, the other 10 at 20 per second
+    assert time.monotonic() - start >= 0.4
+    assert scheduler.projected() == 0.5
+
+
+def test_deferred_mails_are_sent_again(make_mail):
+    sink = SmtpSink(defer_every=3).start()
+    try:
+        delivery = dude.MailDelivery(dude.SmtpConnector(sink.address), workers=2, retries=3, backoff=0.01,
+                                     rate=0, domain_rate=0)
+        mails = [make_mail("user{}@example.org".format(index)) for index in range(10)]
+        results = delivery.deliver(mails)
+    finally:
+        sink.stop()
+    assert [result.mail for result in results] == mails
+    assert all(result.ok for result in results)
+    assert sink.messages == 10
+    assert delivery.deferred == sink.deferred > 0
+    assert max(result.attempts for result in results) > 1
+
+
+def test_retries_are_limited(make_mail):
+    sink = SmtpSink(defer_every=1).start()
+    try:
+        delivery = dude.MailDelivery(dude.SmtpConnector(sink.address), workers=1, retries=2, backoff=0.01,
+                                     rate=0, domain_rate=0)
+        results = delivery.deliver([make_mail("alice@example.org")])
+    finally:
+        sink.stop()
+    assert not results[0].ok
+    assert results[0].attempts == 2
+    assert sink.messages == 0
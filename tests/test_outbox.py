@@ -0,0 +1,97 @@
+import json
+
+import dude
+
+from benchmarks.fakes import FakeDirectory, SmtpSink
+
+PROTOCOL = """
+Simo: Johannes
+Protokoll: Max
+Beginn: 18:15 Uhr
+Ende: 20:03 Uhr
+
+===================
+TOP 1: Finanzen
+===================
+Der Antrag von ${alice} wird angenommen.
+
+===================
+TOP 2: Feier
+===================
+${bob} kümmert sich um die Getränke.
+
+===================
+TOP 3: Sonstiges
+===================
+${carol} fragt nach dem Schlüssel.
+"""
+
+DIRECTORY = FakeDirectory({uid: uid + "@example.org" for uid in ("alice", "bob", "carol")})
+
+
+def send(path, sink, protocol_args):
+    protocol = dude.Protocol(protocol_args(path, sink.address), dude.LdapResolver(connection=DIRECTORY))
+    protocol.get_tops()
+    protocol.send_mails()
+    return protocol
+
+
+def test_interrupted_write_is_ignored(tmp_path, make_mail):
+    path = str(tmp_path / ".2019-10-16.txt.outbox")
+    first, second = make_mail("alice@example.org"), make_mail("bob@example.org")
+    outbox = dude.Outbox(path)
+    outbox.record_many([first, second], dude.Outbox.QUEUED)
+    outbox.record(first, dude.Outbox.SENT)
+    with open(path, "a") as file:
+        file.write('{"top": "TOP 1: Finanzen", "to": "bob@exa')
+
+    outbox = dude.Outbox(path)
+    assert outbox.state(first) == dude.Outbox.SENT
+    assert outbox.state(second) == dude.Outbox.QUEUED
+
+
+def test_reset_forgets_earlier_states(tmp_path, make_mail):
+    path = str(tmp_path / ".2019-10-16.txt.outbox")
+    mail = make_mail("alice@example.org")
+    dude.Outbox(path).record(mail, dude.Outbox.SENT)
+    dude.Outbox(path).reset()
+    assert dude.Outbox(path).state(mail) is None
+
+
+def test_changed_mail_is_not_taken_as_sent(tmp_path, make_mail):
+    path = str(tmp_path / ".2019-10-16.txt.outbox")
+    dude.Outbox(path).record(make_mail("alice@example.org"), dude.Outbox.SENT)
+    assert dude.Outbox(path).state(make_mail("alice@example.org", body="Hallo, neu!")) is None
+
+
+def test_resume_after_crash_sends_only_missing_mails(tmp_path, protocol_args):
+    path = str(tmp_path / "2019-10-16.txt")
+    with open(path, "w") as file:
+        file.write(PROTOCOL)
+    sink = SmtpSink().start()
+    try:
+        assert send(path, sink, protocol_args).mails_sent
+        assert sink.messages == 3
+
+        # a crash after the first mail: all were queued, only one was recorded as sent, the next write was cut off
+        journal = dude.outbox_path(path)
+        with open(journal, "r") as file:
+            entries = [json.loads(line) for line in file]
+        queued = [entry for entry in entries if entry["state"] == dude.Outbox.QUEUED]
+        sent = [entry for entry in entries if entry["state"] == dude.Outbox.SENT]
+        assert len(queued) == len(sent) == 3
+        with open(journal, "w") as file:
+            for entry in queued + sent[:1]:
+                file.write(json.dumps(entry) + "\n")
+            file.write(json.dumps(sent[1])[:20])
+
+        protocol = send(path, sink, protocol_args)
+        assert protocol.mails_sent
+        assert sink.messages == 5
+        assert set(protocol.outbox.states.values()) == {dude.Outbox.SENT}
+
+        # nothing is left to send
+        send(path, sink, protocol_args)
+        assert sink.messages == 5
+    finally:
+        sink.stop()
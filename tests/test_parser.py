@@ -0,0 +1,63 @@
+import dude
+
+PROTOCOL = """
+Simo: Johannes
+Protokoll: Max ${max}
+Beginn: 18:15 Uhr
+
+===================
+TOP 1: Finanzen ${kassenwart}
+===================
+${alice} und ${bob} prüfen den Antrag.
+Ende: kein Header mehr
+
+===================
+TOP 2: Feier
+===================
+${carol}""".split("\n")
+
+
+def test_header_fields_in_front_of_the_first_top():
+    document = dude.parse_protocol(PROTOCOL)
+    assert document.header == {"Simo": "Johannes", "Protokoll": "Max ${max}", "Beginn": "18:15 Uhr"}
+    assert document.length == len(PROTOCOL)
+
+
+def test_tops_and_their_lines():
+    document = dude.parse_protocol(PROTOCOL)
+    assert [(top.number, top.title) for top in document.tops] == [(1, "TOP 1: Finanzen ${kassenwart}"),
+                                                                   (2, "TOP 2: Feier")]
+    first, second = document.tops
+    assert (first.start, first.end) == (5, 10)
+    assert (second.start, second.end) == (11, len(PROTOCOL))
+    assert PROTOCOL[second.start + 1] == "TOP 2: Feier"
+
+
+def test_mentions_are_assigned_to_their_top():
+    document = dude.parse_protocol(PROTOCOL)
+    assert [(mention.top, mention.line, mention.column, mention.text) for mention in document.mentions] == [
+        (-1, 2, 17, "max"),
+        # the title is only recognized at its closing line, its mention moves to the TOP afterwards
+        (0, 6, 18, "kassenwart"),
+        (0, 8, 2, "alice"),
+        (0, 8, 15, "bob"),
+        (1, 14, 2, "carol"),
+    ]
+    assert document.mentions.texts(-1) == ["max"]
+    assert document.mentions.texts(0) == ["kassenwart", "alice", "bob"]
+    assert document.mentions.texts(1) == ["carol"]
+    assert document.mentions.texts(2) == []
+
+
+def test_closing_line_does_not_open_another_title():
+    document = dude.parse_protocol(["===", "TOP 1", "===", "kein Titel", "==="])
+    assert [top.title for top in document.tops] == ["TOP 1"]
+
+
+def test_parse_file_strips_line_endings(tmp_path):
+    path = tmp_path / "2019-10-16.txt"
+    path.write_bytes("\r\n".join(PROTOCOL).encode("utf-8"))
+    document = dude.parse_file(str(path))
+    assert document.header == dude.parse_protocol(PROTOCOL).header
+    assert [top.title for top in document.tops] == ["TOP 1: Finanzen ${kassenwart}", "TOP 2: Feier"]
+    assert document.mentions.texts(1) == ["carol"]
@@ -0,0 +1,59 @@
+import os
+
+import pytest
+
+import dude
+
+BOM = b"\xef\xbb\xbf"
+
+CASES = {
+    # name: (original, edits, header, expected)
+    "lf": (b"a\nb\nc\n", {1: "B"}, ["H"], b"H\na\nB\nc\n"),
+    "crlf": (b"a\r\nb\r\nc\r\n", {1: "B"}, ["H"], b"H\r\na\r\nB\r\nc\r\n"),
+    "bom": (BOM + "Größe\nb\n".encode("utf-8"), {0: "Grüße"}, ["H"], BOM + "H\nGrüße\nb\n".encode("utf-8")),
+    "latin-1": ("Müller\nb\n".encode("latin-1"), {1: "Bär"}, ["Bürger"],
+                "Bürger\nMüller\nBär\n".encode("latin-1")),
+    "no final newline": (b"a\nb", {1: "B"}, ["H"], b"H\na\nB"),
+    "no final newline, unchanged": (b"a\nb", {}, ["H"], b"H\na\nb"),
+    "crlf without final newline": (b"a\r\nb", {0: "A"}, [], b"A\r\nb"),
+}
+
+
+@pytest.fixture(params=[True, False], ids=["from file", "from memory"])
+def from_file(request):
+    """write_protocol copies from the original file if it is unchanged, otherwise from the buffer"""
+    return request.param
+
+
+@pytest.mark.parametrize("name", sorted(CASES))
+def test_round_trip(tmp_path, name, from_file):
+    original, edits, header, expected = CASES[name]
+    path = str(tmp_path / "2019-10-16.txt")
+    with open(path, "wb") as file:
+        file.write(original)
+    buffer = dude.ProtocolBuffer.from_file(path) if from_file else dude.ProtocolBuffer(original)
+
+    dude.write_protocol(path, buffer, edits, header)
+
+    with open(path, "rb") as file:
+        assert file.read() == expected
+    again = dude.ProtocolBuffer.from_file(path)
+    assert (again.encoding, again.newline) == (buffer.encoding, buffer.newline)
+    assert list(again) == header + [edits.get(index, line) for index, line in enumerate(buffer)]
+
+
+def test_lines_without_line_endings():
+    buffer = dude.ProtocolBuffer(BOM + b"a\r\nb\r\nc")
+    assert list(buffer) == ["a", "b", "c"]
+    assert buffer[-1] == "c"
+    assert buffer.newline == b"\r\n"
+
+
+def test_mode_is_kept_and_no_temporary_file_is_left(tmp_path):
+    path = str(tmp_path / "2019-10-16.txt")
+    with open(path, "wb") as file:
+        file.write(b"a\n")
+    os.chmod(path, 0o640)
+    dude.write_protocol(path, dude.ProtocolBuffer.from_file(path), {0: "b"})
+    assert os.stat(path).st_mode & 0o777 == 0o640
+    assert os.listdir(str(tmp_path)) == ["2019-10-16.txt"]